@@ -1,5 +1,5 @@
 # -*- encoding: utf-8 -*-
 
-from .common import PackException, UnpackException
+from .common import PackException, UnpackException, IncompleteDataException
 from .fields.base import CField
-from .struct import CStruct
+from .struct import CStruct, FrozenCStruct
@@ -0,0 +1,148 @@
+# -*- coding: utf-8
+"""
+Pack and unpack throughput of typical structures, compared with
+hand-written `struct` code (see `pystruct.benchmarks.cases`).
+
+Run it with::
+
+    python -m pystruct.benchmarks --save results.json
+    python -m pystruct.benchmarks --compare results.json
+
+Absolute speed depends on the machine, so runs are compared by the
+throughput relative to the baseline. The command fails (exit code 1)
+if any of it dropped by more than `--threshold`.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+from pystruct.benchmarks.cases import CASES
+
+
+def best_time(func, repeat):
+    """The shortest of `repeat` runs of `func`, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        func()
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def measure(case, repeat=5):
+    """
+    Throughput of packing and unpacking the records of `case`.
+    Returns a dictionary of results for each operation.
+    """
+    records = case.records()
+    data = b''.join(record.pack() for record in records)
+    klass = case.klass
+
+    def pack():
+        for record in records:
+            record.pack()
+
+    def pack_baseline():
+        for record in records:
+            case.pack(record)
+
+    def unpack():
+        offset = 0
+        while offset < len(data):
+            _, offset = klass.unpack(data, offset)
+
+    def unpack_baseline():
+        offset = 0
+        while offset < len(data):
+            _, offset = case.unpack(data, offset)
+
+    results = {}
+    for (op, func, baseline) in (('pack', pack, pack_baseline),
+                                 ('unpack', unpack, unpack_baseline)):
+        elapsed = best_time(func, repeat)
+        baseline_elapsed = best_time(baseline, repeat)
+        results[op] = {
+            'records_per_sec': len(records) / elapsed,
+            'bytes_per_sec': len(data) / elapsed,
+            'baseline_records_per_sec': len(records) / baseline_elapsed,
+            'relative': baseline_elapsed / elapsed,
+        }
+    return results
+
+
+def run(cases=CASES, repeat=5):
+    """Results of all the `cases`, keyed by their names."""
+    return dict((case.name, measure(case, repeat)) for case in cases)
+
+
+def compare(previous, current, threshold=0.1):
+    """
+    Slowdowns between two sets of results: a list of `(case, op,
+    previous, current)` tuples of relative throughputs, which dropped
+    by more than `threshold` (a fraction). Cases missing from either
+    run are ignored.
+    """
+    slowdowns = []
+    for name in sorted(current):
+        for op in sorted(current[name]):
+            try:
+                before = previous[name][op]['relative']
+            except KeyError:
+                continue
+            after = current[name][op]['relative']
+            if after < before * (1 - threshold):
+                slowdowns.append((name, op, before, after))
+    return slowdowns
+
+
+def format_table(results):
+    lines = ["{0:<12} {1:<7} {2:>12} {3:>12} {4:>9}".format(
+        "case", "op", "records/s", "MB/s", "relative")]
+    for name in sorted(results):
+        for op in sorted(results[name]):
+            r = results[name][op]
+            lines.append("{0:<12} {1:<7} {2:>12.0f} {3:>12.2f} {4:>9.3f}".format(
+                name, op, r['records_per_sec'], r['bytes_per_sec'] / 1e6,
+                r['relative']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pystruct.benchmarks',
+                                     description=__doc__.split('\n\n')[0])
+    parser.add_argument('cases', nargs='*',
+                        help="names of the cases to run (default: all)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="runs of each measurement, the best one counts")
+    parser.add_argument('--save', metavar='FILE',
+                        help="save the results as JSON")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare with results saved by a previous run")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="allowed slowdown, as a fraction (default: 0.1)")
+    args = parser.parse_args(argv)
+
+    cases = [case for case in CASES if not args.cases or case.name in args.cases]
+    results = run(cases, args.repeat)
+    print(format_table(results))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+        slowdowns = compare(previous, results, args.threshold)
+        for (name, op, before, after) in slowdowns:
+            print("{0} {1}: relative throughput dropped from {2:.3f} to {3:.3f}"
+                  .format(name, op, before, after), file=sys.stderr)
+        if slowdowns:
+            return 1
+    return 0
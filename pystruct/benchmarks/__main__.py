@@ -0,0 +1,5 @@
+import sys
+
+from pystruct.benchmarks import main
+
+sys.exit(main())
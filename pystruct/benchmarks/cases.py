@@ -0,0 +1,163 @@
+# -*- coding: utf-8
+"""
+Benchmarked structures, each paired with a hand-written `struct`
+equivalent, which serves as the baseline.
+"""
+from __future__ import absolute_import
+import struct
+
+from pystruct import CStruct
+from pystruct.fields.complex import ArrayField, StructField
+from pystruct.fields.numeric import (IntField, UIntField, ShortField,
+                                     UShortField, ByteField, UByteField)
+from pystruct.fields.text import (StringField, NullStringField,
+                                  VarcharField, CStructVarString)
+
+
+class Case(object):
+    """
+    A benchmark case: `count` records of `klass`, made by `make(i)`.
+    `pack(record)` and `unpack(data, offset)` are the baseline - they
+    take and return the same things as `record.pack()` and
+    `klass.unpack()`, but use `struct` directly (returning a tuple
+    of values instead of an instance).
+    """
+
+    def __init__(self, name, klass, make, pack, unpack, count):
+        self.name = name
+        self.klass = klass
+        self.make = make
+        self.pack = pack
+        self.unpack = unpack
+        self.count = count
+
+    def records(self):
+        return [self.make(i) for i in range(self.count)]
+
+
+# numbers of all sizes
+class Numbers(CStruct):
+    a = IntField(0)
+    b = UIntField(1)
+    c = ShortField(2)
+    d = UShortField(3)
+    e = ByteField(4)
+    f = UByteField(5)
+
+_numbers = struct.Struct(str('<iIhHbB'))
+
+
+def _unpack_numbers(data, offset):
+    return _numbers.unpack_from(data, offset), offset + _numbers.size
+
+NUMBERS = Case('numeric', Numbers,
+    lambda i: Numbers(a=-i, b=i, c=i % 1000, d=i % 60000, e=i % 100, f=i % 256),
+    lambda r: _numbers.pack(r.a, r.b, r.c, r.d, r.e, r.f),
+    _unpack_numbers, 2000)
+
+
+# fixed-length strings
+class Name(CStruct):
+    name = StringField(0, length=16)
+    id = UIntField(1)
+
+_name = struct.Struct(str('<16sI'))
+
+
+def _unpack_name(data, offset):
+    return _name.unpack_from(data, offset), offset + _name.size
+
+STRING = Case('string', Name,
+    lambda i: Name(name=b'record %d' % i, id=i),
+    lambda r: _name.pack(r.name, r.id),
+    _unpack_name, 2000)
+
+
+# null-terminated strings
+class NullName(CStruct):
+    name = NullStringField(0)
+    id = UIntField(1)
+
+_uint = struct.Struct(str('<I'))
+
+
+def _unpack_null_name(data, offset):
+    end = data.index(b'\0', offset) + 1
+    return (data[offset:end], _uint.unpack_from(data, end)[0]), end + 4
+
+NULL_STRING = Case('null_string', NullName,
+    lambda i: NullName(name=b'record %d\0' % i, id=i),
+    lambda r: r.name + _uint.pack(r.id),
+    _unpack_null_name, 2000)
+
+
+# length-prefixed strings
+class Comment(CStruct):
+    text = VarcharField(0)
+    id = UIntField(1)
+
+
+def _pack_comment(r):
+    text = r.text.text
+    return _uint.pack(len(text)) + text + _uint.pack(r.id)
+
+
+def _unpack_comment(data, offset):
+    length, = _uint.unpack_from(data, offset)
+    start = offset + 4
+    end = start + length
+    return (data[start:end], _uint.unpack_from(data, end)[0]), end + 4
+
+VARCHAR = Case('varchar', Comment,
+    lambda i: Comment(text=CStructVarString(text=b'comment %d' % i), id=i),
+    _pack_comment, _unpack_comment, 2000)
+
+
+# nested structures
+class Point(CStruct):
+    x = IntField(0)
+    y = IntField(1)
+
+
+class Segment(CStruct):
+    start = StructField(0, struct=Point)
+    end = StructField(1, struct=Point)
+    color = UIntField(2)
+
+_segment = struct.Struct(str('<iiiiI'))
+
+
+def _unpack_segment(data, offset):
+    return _segment.unpack_from(data, offset), offset + _segment.size
+
+NESTED = Case('nested', Segment,
+    lambda i: Segment(start=Point(x=i, y=-i), end=Point(x=-i, y=i), color=i),
+    lambda r: _segment.pack(r.start.x, r.start.y, r.end.x, r.end.y, r.color),
+    _unpack_segment, 2000)
+
+
+# large arrays of numbers
+class Samples(CStruct):
+    count = UIntField(0)
+    values = ArrayField(1, length='count', subfield=IntField(0))
+
+SAMPLE_COUNT = 4096
+
+
+def _pack_samples(r):
+    values = list(r.values)
+    return struct.pack(str('<I%di' % len(values)), len(values), *values)
+
+
+def _unpack_samples(data, offset):
+    count, = _uint.unpack_from(data, offset)
+    start = offset + 4
+    values = struct.unpack_from(str('<%di' % count), data, start)
+    return (count, values), start + 4 * count
+
+ARRAY = Case('array', Samples,
+    lambda i: Samples(values=[i * j for j in range(SAMPLE_COUNT)]),
+    _pack_samples, _unpack_samples, 50)
+
+
+CASES = [NUMBERS, STRING, NULL_STRING, VARCHAR, NESTED, ARRAY]
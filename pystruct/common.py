@@ -5,5 +5,17 @@ class UnpackException(Exception):
     pass
 
 
+class IncompleteDataException(UnpackException):
+    """
+    The data ended before the structure did. `needed` is the minimal
+    number of bytes, which have to be appended before unpacking
+    can make any progress.
+    """
+
+    def __init__(self, message, needed=1, constraint=None):
+        UnpackException.__init__(self, message, constraint)
+        self.needed = needed
+
+
 class PackException(Exception):
     pass
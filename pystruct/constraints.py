@@ -9,12 +9,24 @@ PRIO_LENGTH = 700
 PRIO_MAXLENGTH = 750
 PRIO_NBOUNDS = 800
 
-from pystruct.common import PackException
+from pystruct.common import PackException, IncompleteDataException
+
+
+def field_name(opts):
+    """Name of the field the options refer to (may be given explicitly)."""
+    return opts.get('name') or opts['field'].name
 
 
 class Constraint(object):
     __metaclass__ = abc.ABCMeta
 
+    # passive constraints only check values as they are set, so they
+    # don't need to take part in packing and unpacking
+    passive = False
+
+    # set if `before_pack` updates other fields of the structure
+    pack_fixups = False
+
     def __init__(self, priority):
         self.priority = priority
 
@@ -33,6 +45,14 @@ class Constraint(object):
     def on_value_set(self, opts):
         pass
 
+    def on_values_set(self, opts):
+        """
+        Check a batch of values (`opts['values']`) at once, e.g. items
+        of an array. Only used with passive constraints.
+        """
+        for value in opts['values']:
+            self.on_value_set(dict(opts, value=value))
+
 
 class PrefixConstraint(Constraint):
 
@@ -44,18 +64,22 @@ class PrefixConstraint(Constraint):
         self.prefix = param
 
     def match(self, data, pos):
-        l = len(data)
-        for char in self.prefix:
-            if pos >= l:  # prefix exceeds the data
-                return False
-
-            if data[pos] != char:  # characters don't match
-                return False
-            pos += 1
-        return True
+        # comparing slices works the same for every buffer type
+        # (indexing a bytearray gives an int, not a character)
+        return data[pos:pos + len(self.prefix)] == self.prefix
 
     def before_unpack(self, opts):
-        return self.match(opts['data'], opts['offset'])
+        data, pos = opts['data'], opts['offset']
+        if self.match(data, pos):
+            return True
+
+        # the data ends in the middle of a matching prefix
+        available = len(data) - pos
+        if 0 < available < len(self.prefix) \
+          and data[pos:] == self.prefix[:available]:
+            raise IncompleteDataException("Data ends within the prefix.",
+                len(self.prefix) - available, self)
+        return False
 
 
 class OffsetConstraint(Constraint):
@@ -71,6 +95,7 @@ class OffsetConstraint(Constraint):
             raise ValueError("Offset constraint must contain a number or a valid field name.")
 
         self.__offset = param
+        self.pack_fixups = isinstance(param, str)
 
     def before_upack_number(self, options):
         if self.__offset != options['offset']:
@@ -92,12 +117,15 @@ class OffsetConstraint(Constraint):
             setattr(options['obj'], self.__offset, options['offset'])
 
     def pack(self, options):
-        if isinstance(self.__offset, int) and (options['offset'] != self.__offset):
+        # `base` is where the packed data starts in the buffer
+        position = options['offset'] - options.get('base', 0)
+        if isinstance(self.__offset, int) and (position != self.__offset):
             raise PackException("Explicit offset of field %s was set, but position doesn't match" % \
-                options['field'].name)
+                field_name(options))
 
 
 class ValueTypeConstraint(Constraint):
+    passive = True
 
     def __init__(self, typeklass, priority=PRIO_TYPE):
         super(ValueTypeConstraint, self).__init__(priority)
@@ -108,10 +136,19 @@ class ValueTypeConstraint(Constraint):
 
     def on_value_set(self, opts):
         if not isinstance(opts['value'], self._klass):
-            raise ValueError("{value!r} is not a valid value for field {field.name}.".format(**opts))
+            raise ValueError("{0!r} is not a valid value for field {1}.".format(
+                opts['value'], field_name(opts)))
+
+    def on_values_set(self, opts):
+        klass = self._klass
+        for value in opts['values']:
+            if not isinstance(value, klass):
+                self.on_value_set(dict(opts, value=value))
 
 
 class NumericBounds(Constraint):
+    passive = True
+
     BOUND_FOR_CTYPE = {
         'int': (-(2 ** 31) + 1, 2 ** 31),
         'uint': (0, 2 ** 32 - 1),
@@ -136,7 +173,14 @@ class NumericBounds(Constraint):
     def on_value_set(self, opts):
         if not (self._lbound <= opts['value'] <= self._ubound):
             raise ValueError("Field %s - value %s out of bounds."\
-                % (opts['field'].name, opts['value']))
+                % (field_name(opts), opts['value']))
+
+    def on_values_set(self, opts):
+        values = opts['values']
+        if not values:
+            return
+        for value in (min(values), max(values)):
+            self.on_value_set(dict(opts, value=value))
 
 
 class LengthConstraint(Constraint):
@@ -157,6 +201,13 @@ class LengthConstraint(Constraint):
         self.__length = length
         self.__padding_func = padding_func
 
+    @property
+    def fixed_length(self):
+        """The length, if it doesn't depend on data or other fields."""
+        if isinstance(self.__length, int) and self.__length >= 0:
+            return self.__length
+        return None
+
     def on_value_set(self, opts):
         L = len(opts['value'])
         if isinstance(self.__length, property):
@@ -167,7 +218,7 @@ class LengthConstraint(Constraint):
             return  # do nothing
 
         if L > self.__length:
-            raise ValueError("Field %s has limited length of %d." % (opts['field'].name, self.__length))
+            raise ValueError("Field %s has limited length of %d." % (field_name(opts), self.__length))
 
         if self.__padding_func:
             opts['padding'] = (self.__length - L)
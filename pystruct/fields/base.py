@@ -3,7 +3,8 @@
 from __future__ import unicode_literals
 import struct
 from pystruct.constraints import OffsetConstraint, PrefixConstraint
-from pystruct.common import UnpackException
+from pystruct.common import UnpackException, IncompleteDataException
+from pystruct.utils import PackBuffer, reserve
 
 
 class CField(object):
@@ -12,6 +13,14 @@ class CField(object):
         'prefix': PrefixConstraint,
     }
 
+    # set when the field is attached to a structure; fields don't change
+    # during packing or unpacking, so they can be shared between threads -
+    # anything call-specific (like the name of an array item the field
+    # stands for) is passed in `opts['name']` instead
+    name = None
+    # the structure class the field was declared in
+    owner = None
+
     def __init__(self, idx, default=None, **kwargs):
         self.idx = idx
         self.default = default
@@ -52,8 +61,10 @@ class CField(object):
         """
         Pack dry-run, so that the field can update dependencies.
         """
-        value = getattr(obj, self.name)
+        name = opts.get('name') or self.name
+        value = getattr(obj, name)
         opts.update({'field': self,
+                     'name': name,
                      'obj': obj,
                      'value': value,
                      'offset': offset})
@@ -68,21 +79,46 @@ class CField(object):
         """
         Pack the field into a byte array.
         """
-        value = getattr(obj, self.name)
+        if self.pack_fixups():
+            self.before_pack(obj, offset, **opts)
+        buf = PackBuffer()
+        end = self.pack_into(obj, buf, 0, **dict(opts, base=-offset))
+        return bytes(buf[:end])
+
+    def pack_into(self, obj, buf, offset, **opts):
+        """
+        Pack the field into a writable buffer, starting at `offset`.
+        Returns the offset just past the packed data. Positions checked
+        by the constraints are relative to `opts['base']` (the start
+        of the buffer by default).
+        """
+        name = opts.get('name') or self.name
+        value = getattr(obj, name)
 
         if (value == None) and self.nullable:
-            return b''  # field is omitted
+            return offset  # field is omitted
 
         opts.update({'field': self,
+                     'name': name,
                      'obj': obj,
                      'value': value,
                      'offset': offset})
         for c in reversed(self.constraints):
             c.pack(opts)
 
-        return struct.pack(self._format_string(opts), value)
+        fmt = struct.Struct(str(self._format_string(opts)))
+        reserve(buf, offset + fmt.size)
+        fmt.pack_into(buf, offset, self._packable_of(opts))
+        return offset + fmt.size
+
+    def pack_fixups(self):
+        """
+        Does packing the field update other fields (in `before_pack`)?
+        Structures with such fields are packed in two passes.
+        """
+        return any(c.pack_fixups for c in self.constraints)
 
-    def unpack(self, obj, data, pos):
+    def unpack(self, obj, data, pos, **opts):
         """
         Unpack the given byte buffer into this field, starting at `pos`.
         """
@@ -90,7 +126,7 @@ class CField(object):
         #  * is the field at given offset ? (yes, this always comes first)
         #  * does the field prefix match ?
         #  * any other stuff the user wants to check
-        opts = {'obj': obj, 'data': data, 'offset': pos}
+        opts.update({'obj': obj, 'data': data, 'offset': pos})
         self._before_unpack(opts)
 
         if not opts.get('__ommit', False):
@@ -98,14 +134,84 @@ class CField(object):
         else:
             return (None, pos)
 
+    def skip(self, obj, data, pos):
+        """
+        Return the offset just past this field's data at `pos`,
+        without decoding the value where the layout allows it.
+        """
+        opts = {'obj': obj, 'data': data, 'offset': pos}
+        self._before_unpack(opts)
+
+        if not opts.get('__ommit', False):
+            return self._skip_value(opts)
+        else:
+            return pos
+
+    def _skip_value(self, opts):
+        fmt = self._format_string(opts)
+        return opts['offset'] + struct.calcsize(str(fmt))
+
     def _format_string(self, opts):
         """The format string for the default retrieval method"""
         return ''
 
+    def _packable(self, value):
+        """Convert the value to something `struct.pack` accepts."""
+        return value
+
+    def _packable_of(self, opts):
+        """`_packable` of the value being packed (see `pack_into`)."""
+        return self._packable(opts['value'])
+
+    # fixed layout - fields which always occupy the same number of bytes
+    # and need no per-field logic are packed and unpacked in runs,
+    # by a single precompiled struct (see `pystruct.layout`)
+
+    # does one item of `fixed_format` map directly to the value ?
+    fixed_scalar = True
+
+    def _active_constraints(self):
+        """Constraints, which take part in packing and unpacking."""
+        return [c for c in self.constraints if not c.passive]
+
+    def fixed_format(self):
+        """
+        The format string (without byte order) of the field, or `None`
+        if the layout of the field depends on the data.
+        """
+        return None
+
+    def fixed_values(self, value):
+        """Turn the value into a sequence of items for `fixed_format`."""
+        return (value,)
+
+    def from_fixed(self, items, validate=False):
+        """Build the value back from items unpacked by `fixed_format`."""
+        return items[0]
+
+    def _fixed_length(self):
+        """The length given by a constant `length` constraint, or `None`."""
+        for c in self.constraints:
+            if getattr(c, 'keyword', None) == 'length':
+                return c.fixed_length
+        return None
+
+    def numpy_dtype(self):
+        """
+        NumPy dtype of the field (see `CStruct.numpy_dtype`). Raises
+        `ValueError` if the size of the field depends on the data.
+        """
+        raise ValueError("Field {0} has no fixed size.".format(self.name))
+
     def _retrieve_value(self, opts):
         fmt = self._format_string(opts)
         fmt_len = struct.calcsize(fmt)
-        v = struct.unpack_from(fmt, opts['data'], opts['offset'])
+        try:
+            v = struct.unpack_from(fmt, opts['data'], opts['offset'])
+        except struct.error:
+            raise IncompleteDataException(
+                "Not enough data for field {0}.".format(self.name),
+                opts['offset'] + fmt_len - len(opts['data']))
         return (v, opts['offset'] + fmt_len)
 
     def get_value(self, obj, current_value):
@@ -114,7 +220,7 @@ class CField(object):
         """
         return current_value
 
-    def set_value(self, obj, new_value):
+    def set_value(self, obj, new_value, name=None):
         """
         Set value of this field in given object.
         """
@@ -123,7 +229,8 @@ class CField(object):
             return None
 
         # the new value is not yet set on the object
-        opts = {'field': self, 'obj': obj, 'value': new_value}
+        opts = {'field': self, 'obj': obj, 'value': new_value,
+                'name': name or self.name}
 
         # trigger constraints
         for constr in self.constraints:
@@ -131,5 +238,44 @@ class CField(object):
 
         return opts['value']
 
+    def set_trusted_value(self, obj, new_value):
+        """
+        Like `set_value`, but for values known to be valid - e.g. ones
+        just unpacked in the declared format. No constraints are run.
+        """
+        return new_value
+
+    # does `reuse_value` ever update the current value ?
+    reuses_value = False
+
+    def reuse_value(self, obj, current, new_value):
+        """
+        Like `set_trusted_value`, but the value the field has now
+        (`current`, `None` if there's none) may be updated in place
+        and returned instead - see `CStruct.unpack_into`.
+        """
+        return self.set_trusted_value(obj, new_value)
+
+    def reusable_class(self):
+        """
+        The class of the structure nested in the field, if unpacking
+        may decode it into an existing instance (see `UnpackScratch`).
+        """
+        return None
+
+    def check_values(self, obj, values, name):
+        """
+        Validate a batch of values at once (e.g. items of an array),
+        reporting errors as field `name`. Only for fields, whose
+        constraints are all passive.
+        """
+        opts = {'field': self, 'obj': obj, 'values': values, 'name': name}
+        for constr in self.constraints:
+            constr.on_values_set(opts)
+
+    def struct_classes(self):
+        """Structure classes, which values of the field contain."""
+        return ()
+
     def __unicode__(self):
         return u"<Field: {0.name}".format(self)
@@ -1,13 +1,22 @@
 # -*- coding: utf-8
 
+import array
+import struct
+from pystruct.common import IncompleteDataException
 from pystruct.fields.base import CField
 from pystruct.constraints import LengthConstraint, ValueTypeConstraint
-from pystruct.utils import ListItemWrapper
+from pystruct.struct import Dispatcher
+from pystruct.utils import ListItemWrapper, TypedArray, reserve
 
 
 def array_padder(opts):
     pad = opts['padding']
-    opts['value']._extend(None for _ in range(0, pad))
+    value = opts['value']
+    if isinstance(value, TypedArray):
+        # C numbers can't be None - pad with zeros
+        array.array.extend(value, array.array(value.typecode, [0]) * pad)
+    else:
+        value._extend(None for _ in range(0, pad))
 
 
 class ArrayField(CField):
@@ -19,82 +28,238 @@ class ArrayField(CField):
         CField.__init__(self, idx, default, **dict(kwargs, length=length))
         self.__subfield = subfield
 
+        # arrays of plain numbers are packed and unpacked in one go,
+        # and kept in a `TypedArray` - if there's a C type of the same size
+        fmt = subfield.fixed_format()
+        self._item_code = None
+        if fmt is not None and len(fmt) == 1 and subfield.fixed_scalar:
+            self._item_size = struct.calcsize(str('<' + fmt))
+            if array.array(str(fmt)).itemsize == self._item_size:
+                self._item_code = fmt
+
+        # a `TypedArray` is decoded anew - unlike the wrappers of other
+        # items, it isn't tracked by the garbage collector
+        self.reuses_value = self._item_code is None
+        # the items can be added or removed in place only if the length
+        # isn't stored anywhere (the array takes the rest of the data)
+        self._resizable = isinstance(length, int) and length < 0
+
+        # items, which can be packed or unpacked all at once
+        # (e.g. null strings, variable-length numbers)
+        self._pack_items = self._unpack_items = None
+        if not subfield._active_constraints() and not subfield.nullable:
+            self._pack_items = getattr(subfield, 'pack_consecutive', None)
+            self._unpack_items = getattr(subfield, 'unpack_consecutive', None)
+
+    # the subfield is named after the array, for error messages
+    _name = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        self._name = value
+        self.__subfield.name = value + '[]'
+
     # packing
     def before_pack(self, obj, offset, **opts):
-        value = getattr(obj, self.name)
+        name = opts.get('name') or self.name
+        value = getattr(obj, name)
 
         if (value == None) and self.nullable:
             return 0
+        if isinstance(value, tuple):
+            value = self._wrap(value)  # items of a frozen structure
 
-        opts.update({'field': self, 'obj': obj, 'value': value})
+        opts.update({'field': self, 'name': name, 'obj': obj, 'value': value})
         for c in reversed(self.constraints):
             c.before_pack(opts)
 
+        if self._item_code is not None:
+            return opts['length'] * self._item_size
+        if self._pack_items is not None:
+            return len(self._pack_items(value._object))
+
         data_len = 0
         off = offset
         for i in range(0, opts['length']):
             # map the field to index i
-            self.__subfield.name = str(i)
-            sf_len = self.__subfield.before_pack(value, off)
+            sf_len = self.__subfield.before_pack(value, off, name=str(i))
             data_len += sf_len
             off += sf_len
 
         return data_len
 
-    def pack(self, obj, offset, **opts):
-        value = getattr(obj, self.name)
+    def pack_into(self, obj, buf, offset, **opts):
+        name = opts.get('name') or self.name
+        value = getattr(obj, name)
 
         if (value == None) and self.nullable:
-            return ''
+            return offset
+        if isinstance(value, tuple):
+            value = self._wrap(value)  # items of a frozen structure
 
-        opts.update({'field': self, 'obj': obj, 'value': value})
+        opts.update({'field': self, 'name': name, 'obj': obj, 'value': value})
         for c in reversed(self.constraints):
             c.pack(opts)
 
         # all constraints to this field applied
-        buffer = bytes()
-        off = offset
+        if self._item_code is not None:
+            # straight from the array's memory
+            reserve(buf, offset + len(value) * self._item_size)
+            return value.pack_into(buf, offset)
+        if self._pack_items is not None:
+            data = self._pack_items(value._object)
+            reserve(buf, offset + len(data))
+            struct.pack_into(str('%ds' % len(data)), buf, offset, data)
+            return offset + len(data)
+
         for i in range(0, opts['length']):
             # map the field to index i
-            self.__subfield.name = str(i)
-            data = self.__subfield.pack(value, off)
-            off += len(data)
-            buffer += data
-        return buffer
+            offset = self.__subfield.pack_into(value, buf, offset, name=str(i),
+                                               base=opts.get('base', 0))
+        return offset
 
     # unpacking
+    def pack_fixups(self):
+        return CField.pack_fixups(self) or self.__subfield.pack_fixups()
+
+    def struct_classes(self):
+        return self.__subfield.struct_classes()
+
+    def _fixed_end(self, opts):
+        """End of the array, if its size is known from the layout alone."""
+        fmt = self.__subfield.fixed_format()
+        if fmt is None or opts['length'] < 0:
+            return None
+        return opts['offset'] + opts['length'] * struct.calcsize(str('<' + fmt))
+
     def _retrieve_value(self, opts):
         l = []
         data_len = len(opts['data'])
         array_len = opts['length']
         offset = opts['offset']
 
+        # don't let the caller find out about missing data piece by piece
+        end = self._fixed_end(opts)
+        if end is not None and end > data_len:
+            raise IncompleteDataException(
+                "Not enough data for field {0}.".format(self.name),
+                end - data_len)
+
+        if self._item_code is not None:
+            if array_len < 0:
+                # the rest of the data, rounded up to whole items
+                array_len = -(-(data_len - offset) // self._item_size)
+            end = offset + array_len * self._item_size
+            if end > data_len:
+                raise IncompleteDataException(
+                    "Not enough data for field {0}.".format(self.name),
+                    end - data_len)
+            items = self._wrap(())
+            items.load(opts['data'][offset:end])
+            return (items, end)
+
+        if self._unpack_items is not None:
+            return self._unpack_items(opts['data'], offset, array_len)
+
         i = 0
         while (array_len < 0 and offset < data_len) or (0 <= i < array_len):
-            self.__subfield.name = str(i)
-            v, offset = self.__subfield.unpack(opts['obj'], opts['data'], offset)
+            v, offset = self.__subfield.unpack(opts['obj'], opts['data'], offset,
+                                               validate=opts.get('validate', False))
             l.append(v)
             i += 1
 
         return (l, offset)
 
+    def _skip_value(self, opts):
+        end = self._fixed_end(opts)
+        if end is not None:
+            return end
+
+        data = opts['data']
+        array_len = opts['length']
+        offset = opts['offset']
+
+        i = 0
+        while (array_len < 0 and offset < len(data)) or (0 <= i < array_len):
+            offset = self.__subfield.skip(opts['obj'], data, offset)
+            i += 1
+        return offset
+
+    fixed_scalar = False
+
+    def fixed_format(self):
+        length = self._fixed_length()
+        if self._item_code is None or length is None \
+          or self.nullable or len(self._active_constraints()) != 1:
+            return None
+        return str(length) + self._item_code
+
+    def fixed_values(self, value):
+        return value
+
+    def from_fixed(self, items, validate=False):
+        return self._wrap(items)
+
+    def numpy_dtype(self):
+        import numpy
+        length = self._fixed_length()
+        if self.nullable or length is None:
+            return CField.numpy_dtype(self)
+        return numpy.dtype((self.__subfield.numpy_dtype(), (length,)))
+
     def item_set_value(self, wrapper, item_name, new_value):
         # let the subfield se the value - this validates
-        # print self, wrapper, item_name, new_value
-        self.__subfield.name = item_name
-        return self.__subfield.set_value(wrapper, new_value)
+        return self.__subfield.set_value(wrapper, new_value, name=item_name)
 
     def item_get_value(self, wrapper, item_name, current_value):
-        # let the subfield se the value - this validates
-        self.__subfield.name = item_name
         return self.__subfield.get_value(wrapper, current_value)
 
     # override set, to wrap the value
-    def set_value(self, obj, value):
+    def set_value(self, obj, value, name=None):
+        name = name or self.name
+        if value is self.default:
+            # padding extends the list - don't let it touch the default
+            value = list(value)
+        if value is not None and (self._item_code is not None
+                                  or self._pack_items is not None):
+            # validate all the items at once
+            self.__subfield.check_values(obj, value, name)
+
+        value = CField.set_value(self, obj, self._wrap(value), name)
+        if value is not None and getattr(obj, '_frozen', False):
+            # structures, which can't change, keep the items in a tuple
+            return tuple(getattr(value, '_object', value))
+        return value
+
+    def set_trusted_value(self, obj, value):
+        if value is not None and getattr(obj, '_frozen', False):
+            return tuple(value)
+        if isinstance(value, TypedArray):
+            return value  # built by unpacking
+        return self._wrap(value)
+
+    def reuse_value(self, obj, current, value):
+        if isinstance(current, ListItemWrapper) and isinstance(value, list):
+            # keep the wrapper, with the new items
+            current._object = value
+            return current
+        return self.set_trusted_value(obj, value)
+
+    def _check_items(self, items):
+        self.__subfield.check_values(None, items, self.name)
+
+    def _wrap(self, value):
+        if self._item_code is not None and value is not None:
+            return TypedArray(self._item_code, value, self._check_items,
+                              self._resizable)
         wrapper = ListItemWrapper(value)
         wrapper._set_action = self.item_set_value
         wrapper._get_action = self.item_get_value
-        return CField.set_value(self, obj, wrapper)
+        return wrapper
 
     # no need to wrap the get
 
@@ -110,26 +275,116 @@ class StructField(CField):
         self._struct_klass = struct
 
     def before_pack(self, obj, offset, **opts):
-        value = getattr(obj, self.name)
+        name = opts.get('name') or self.name
+        value = getattr(obj, name)
         if (value == None) and self.nullable:
             return 0
 
-        opts.update({'field': self, 'obj': obj, 'value': value, 'offset': offset})
+        opts.update({'field': self, 'name': name, 'obj': obj, 'value': value,
+                     'offset': offset})
         for c in reversed(self.constraints):
             c.before_pack(opts)
 
-        return value._before_pack(offset)
+        return value._before_pack(offset) - offset
 
-    def pack(self, obj, offset, **opts):
-        value = getattr(obj, self.name)
+    def pack_into(self, obj, buf, offset, **opts):
+        name = opts.get('name') or self.name
+        value = getattr(obj, name)
         if (value == None) and self.nullable:
-            return ''
+            return offset
 
-        opts.update({'field': self, 'obj': obj, 'value': value, 'offset': offset})
+        opts.update({'field': self, 'name': name, 'obj': obj, 'value': value,
+                     'offset': offset})
         for c in reversed(self.constraints):
             c.pack(opts)
 
-        return value._pack(offset)
+        return value._pack_into(buf, offset, opts.get('base', 0))
+
+    def pack_fixups(self):
+        return CField.pack_fixups(self) or self._struct_klass._pack_fixups
+
+    def struct_classes(self):
+        return (self._struct_klass,)
+
+    def _retrieve_value(self, opts):
+        return self._struct_klass.unpack(opts['data'], opts['offset'],
+                                         opts.get('validate', False))
+
+    def reusable_class(self):
+        klass = self._struct_klass
+        return None if klass._frozen else klass
+
+    def unpack_spare(self, obj, spare, data, pos, scratch):
+        """`unpack`, but into the `spare` instance of the nested structure."""
+        opts = {'obj': obj, 'data': data, 'offset': pos}
+        self._before_unpack(opts)
+        if opts.get('__ommit', False):
+            return (None, pos)
+        return spare, self._struct_klass._unpack_into(spare, data, pos,
+                                                      scratch=scratch)
+
+    def _skip_value(self, opts):
+        return self._struct_klass._skip(opts['data'], opts['offset'])
+
+    def numpy_dtype(self):
+        if self.nullable:
+            return CField.numpy_dtype(self)
+        return self._struct_klass.numpy_dtype()
+
+    fixed_scalar = False
+
+    def fixed_format(self):
+        run = self._struct_klass._fixed_run
+        if run is None or self.nullable or self._active_constraints():
+            return None
+        return run.format
+
+    def fixed_values(self, value):
+        return self._struct_klass._fixed_run.flatten(value)
+
+    def from_fixed(self, items, validate=False):
+        klass = self._struct_klass
+        values = klass._fixed_run.unflatten(items, validate)
+        return klass._from_values(values, validate)
+
+
+class UnionField(StructField):
+    """
+    Field containing one of several sub-structures, told apart by
+    their prefixes (see `pystruct.struct.Dispatcher`).
+    """
+
+    def __init__(self, idx, structs, default=None, **kwargs):
+        CField.__init__(self, idx, default, **kwargs)
+        self._dispatcher = Dispatcher(structs)
 
     def _retrieve_value(self, opts):
-        return self._struct_klass.unpack(opts['data'], opts['offset'])
+        return self._dispatcher.unpack(opts['data'], opts['offset'],
+                                       opts.get('validate', False))
+
+    def reusable_class(self):
+        return None  # the type is only known from the data
+
+    def _skip_value(self, opts):
+        klass = self._dispatcher.klass_for(opts['data'], opts['offset'])
+        return klass._skip(opts['data'], opts['offset'])
+
+    def pack_fixups(self):
+        return CField.pack_fixups(self) or \
+            any(klass._pack_fixups for klass in self._dispatcher.structs)
+
+    def struct_classes(self):
+        return self._dispatcher.structs
+
+    def numpy_dtype(self):
+        return CField.numpy_dtype(self)
+
+    def fixed_format(self):
+        return None
+
+    def set_value(self, obj, value, name=None):
+        if value is not None and \
+          not isinstance(value, self._dispatcher.structs):
+            raise ValueError("{0!r} is not a valid value for field {1}."
+                             .format(value, name or self.name))
+        return CField.set_value(self, obj, value, name)
@@ -3,8 +3,13 @@
 from __future__ import unicode_literals
 import numbers
 from pystruct.fields.base import CField
+from pystruct.common import UnpackException, IncompleteDataException
+from pystruct.utils import buffer_slice
 import pystruct.constraints as const
 
+# at most 10 bytes are needed for a 64-bit variable-length integer
+MAX_VARINT_SIZE = 10
+
 
 class NumericField(CField):
     FMT_STRING = {
@@ -31,6 +36,17 @@ class NumericField(CField):
         v, offset = super(NumericField, self)._retrieve_value(opts)
         return (v[0], offset)
 
+    def fixed_format(self):
+        if self.nullable or self._active_constraints():
+            return None
+        return NumericField.FMT_STRING[self.__ctype]
+
+    def numpy_dtype(self):
+        import numpy
+        if self.nullable:
+            return CField.numpy_dtype(self)
+        return numpy.dtype(str('<' + NumericField.FMT_STRING[self.__ctype]))
+
 
 # some useful shorthands
 class IntField(NumericField):
@@ -61,3 +77,123 @@ class ByteField(NumericField):
 class UByteField(NumericField):
     def __init__(self, idx, default=0, **kwargs):
         NumericField.__init__(self, idx, default, **dict(kwargs, ctype='ubyte'))
+
+
+def encode_varuints(values):
+    """Encode unsigned numbers as LEB128 (7 bits per byte)."""
+    out = bytearray()
+    append = out.append
+    for value in values:
+        while value > 0x7f:
+            append((value & 0x7f) | 0x80)
+            value >>= 7
+        append(value)
+    return bytes(out)
+
+
+def decode_varuints(data, offset, count):
+    """
+    Decode `count` LEB128 numbers at `offset` in `data` (as many as
+    there are up to the end of the data, if `count` is negative).
+    Returns a list of the numbers and the offset just past them.
+    """
+    stop = len(data)
+    if count >= 0:
+        stop = min(stop, offset + count * MAX_VARINT_SIZE)
+    chunk = bytearray(buffer_slice(data, offset, stop))
+
+    values = []
+    value = shift = end = 0
+    for (index, byte) in enumerate(chunk):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            if shift >= 7 * MAX_VARINT_SIZE:
+                raise UnpackException("Variable-length integer at offset {0} "
+                                      "is too long.".format(offset + end))
+            continue
+        if shift == 7 * (MAX_VARINT_SIZE - 1) and byte > 1:
+            raise UnpackException("Variable-length integer at offset {0} "
+                                  "doesn't fit in 64 bits.".format(offset + end))
+        values.append(value)
+        value = shift = 0
+        end = index + 1
+        if len(values) == count:
+            break
+
+    if shift or len(values) < count:
+        raise IncompleteDataException(
+            "Not enough data for a variable-length integer.")
+    return values, offset + end
+
+
+class VarUIntField(CField):
+    """
+    Unsigned integer of variable size (LEB128) - small numbers take
+    less space: up to 127 takes one byte, up to 16383 two, etc.
+    """
+    BOUNDS = (0, 2 ** 64 - 1)
+
+    def __init__(self, idx, default=0, **kwargs):
+        CField.__init__(self, idx, default, **kwargs)
+        self.add_constraint(const.ValueTypeConstraint(numbers.Integral))
+        self.add_constraint(const.NumericBounds(*self.BOUNDS))
+
+    def _to_unsigned(self, value):
+        return value
+
+    def _from_unsigned(self, value):
+        return value
+
+    def _encoded(self, opts):
+        # the size and the data of the field both need the encoding -
+        # it's kept in the options of the (single) pack call
+        data = opts.get('encoded')
+        if data is None:
+            data = opts['encoded'] = self._packable(opts['value'])
+        return data
+
+    def _format_string(self, opts):
+        return '<{0}s'.format(len(self._encoded(opts)))
+
+    def _packable(self, value):
+        return encode_varuints((self._to_unsigned(value),))
+
+    def _packable_of(self, opts):
+        return self._encoded(opts)
+
+    def _retrieve_value(self, opts):
+        values, end = decode_varuints(opts['data'], opts['offset'], 1)
+        return (self._from_unsigned(values[0]), end)
+
+    def _skip_value(self, opts):
+        return decode_varuints(opts['data'], opts['offset'], 1)[1]
+
+    # arrays of the numbers are encoded and decoded all at once
+
+    def pack_consecutive(self, values):
+        """Encode all the `values` one after another."""
+        return encode_varuints([self._to_unsigned(v) for v in values])
+
+    def unpack_consecutive(self, data, offset, count):
+        """
+        Decode `count` numbers at `offset` (see `decode_varuints`).
+        Returns a list of the values and the end offset.
+        """
+        values, end = decode_varuints(data, offset, count)
+        return [self._from_unsigned(v) for v in values], end
+
+
+class VarIntField(VarUIntField):
+    """
+    Signed integer of variable size. Numbers are zigzag-encoded first
+    (0, -1, 1, -2, ... become 0, 1, 2, 3, ...), so the ones close
+    to zero take little space, whatever their sign.
+    """
+    BOUNDS = (-2 ** 63, 2 ** 63 - 1)
+
+    def _to_unsigned(self, value):
+        return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+    def _from_unsigned(self, value):
+        return (value >> 1) ^ -(value & 1)
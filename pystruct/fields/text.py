@@ -4,26 +4,50 @@
 from __future__ import unicode_literals
 
 from pystruct.fields.base import CField
-from pystruct.fields.numeric import UIntField
+from pystruct.fields.numeric import UIntField, VarUIntField
 from pystruct.fields.complex import StructField
 from pystruct.struct import CStruct
-from pystruct.common import UnpackException
+from pystruct.common import IncompleteDataException
 from pystruct.constraints import LengthConstraint, MaxLengthConstraint
+from pystruct.utils import (VIEW_TYPES, buffer_slice, find_byte, find_bytes,
+                            to_bytes)
 
 from functools import partial
 
 
 def string_padder(opts):
     pad = opts['padding']
-    opts['value'] += pad * b'\x00'
+    if pad:
+        opts['value'] += pad * b'\x00'
+
+
+def retrieve_string(field, opts):
+    """
+    Retrieve `opts['length']` bytes for a string field. With `view`
+    enabled on the field, the value is a slice of the source buffer
+    instead of a copy.
+    """
+    if not field.view:
+        (v, offset) = CField._retrieve_value(field, opts)
+        return (v[0], offset)
+
+    field._format_string(opts)  # resolve the length
+    start = opts['offset']
+    end = start + opts['length']
+    if end > len(opts['data']):
+        raise IncompleteDataException(
+            "Not enough data for field {0}.".format(field.name),
+            end - len(opts['data']))
+    return (buffer_slice(opts['data'], start, end), end)
 
 
 class StringField(CField):
     KEYWORDS = dict(CField.KEYWORDS,
         length=partial(LengthConstraint, padding_func=string_padder))
 
-    def __init__(self, idx, default='', length=0, **kwargs):
+    def __init__(self, idx, default='', length=0, view=False, **kwargs):
         CField.__init__(self, idx, default, **dict(kwargs, length=length))
+        self.view = view
 
     def _format_string(self, opts):
         if opts['length'] == -1:
@@ -31,43 +55,96 @@ class StringField(CField):
 
         return '<' + str(opts['length']) + 's'
 
-    def _retrieve_value(self, opts):
-        (v, offset) = CField._retrieve_value(self, opts)
-        return (v[0], offset)
+    _retrieve_value = retrieve_string
+
+    def _packable(self, value):
+        return to_bytes(value)
+
+    def fixed_format(self):
+        active = self._active_constraints()
+        if self.view or self.nullable or len(active) != 1:
+            return None
+        length = getattr(active[0], 'fixed_length', None)
+        if length is None:
+            return None
+        return str(length) + 's'
+
+    def numpy_dtype(self):
+        import numpy
+        length = self._fixed_length()
+        if self.nullable or length is None:
+            return CField.numpy_dtype(self)
+        return numpy.dtype(str('S' + str(length)))
 
 
 class NullStringField(CField):
     KEYWORDS = dict(CField.KEYWORDS, max_length=MaxLengthConstraint)
 
+    def __init__(self, idx, default=None, view=False, **kwargs):
+        CField.__init__(self, idx, default, **kwargs)
+        self.view = view
+
     def _format_string(self, opts):
         return '<' + str(opts['length']) + 's'
 
     def _before_unpack(self, opts):
         CField._before_unpack(self, opts)
-        try:
-            opts['length'] = opts['data'].index('\0', opts['offset']) - opts['offset'] + 1
-            if "max_length" in opts:
-                opts['length'] = min(opts['max_length'], opts['length'])
-        except ValueError:
-            raise UnpackException("Unterminated null string occured.")
+        start = opts['offset']
+        limit = len(opts['data'])
+        max_length = opts.get('max_length')
+        if max_length is not None:
+            # don't look for the terminator past the maximum length
+            limit = min(limit, start + max_length)
+
+        end = find_byte(opts['data'], b'\0', start, limit)
+        if end >= 0:
+            opts['length'] = end - start + 1
+        elif limit - start == max_length:
+            opts['length'] = max_length
+        else:
+            raise IncompleteDataException("Unterminated null string occured.")
+
+    def unpack_consecutive(self, data, offset, count):
+        """
+        Unpack `count` strings following each other at `offset` (as many
+        as there are up to the end of the data, if `count` is negative),
+        locating all the terminators in one pass. Only for fields without
+        constraints. Returns a list of the values and the end offset.
+        """
+        ends = find_bytes(data, b'\0', offset, None if count < 0 else count)
+        if count < 0:
+            complete = (ends[-1] + 1 if ends else offset) == len(data)
+        else:
+            complete = len(ends) == count
+        if not complete:
+            raise IncompleteDataException("Unterminated null string occured.")
+
+        values = []
+        for end in ends:
+            value = buffer_slice(data, offset, end + 1)
+            values.append(value if self.view else to_bytes(value))
+            offset = end + 1
+        return values, offset
 
     def before_pack(self, obj, offset, **opts):
-        value = getattr(obj, self.name)
+        value = getattr(obj, opts.get('name') or self.name)
         return CField.before_pack(self, obj, offset, length=len(value), **opts)
 
-    def pack(self, obj, offset, **opts):
-        value = getattr(obj, self.name)
-        return CField.pack(self, obj, offset, length=len(value), **opts)
+    def pack_into(self, obj, buf, offset, **opts):
+        value = getattr(obj, opts.get('name') or self.name)
+        return CField.pack_into(self, obj, buf, offset,
+                                length=len(value), **opts)
 
-    def _retrieve_value(self, opts):
-        (v, offset) = CField._retrieve_value(self, opts)
-        return (v[0], offset)
+    _retrieve_value = retrieve_string
+
+    def _packable(self, value):
+        return to_bytes(value)
 
-    def set_value(self, obj, value):
-        if not isinstance(value, bytes) or value[-1] != b'\0':
+    def set_value(self, obj, value, name=None):
+        if not isinstance(value, (bytes,) + VIEW_TYPES) or value[-1:] != b'\0':
             raise ValueError("NullStringField value must a string with last character == '\\0'.")
 
-        return CField.set_value(self, obj, value)
+        return CField.set_value(self, obj, value, name)
 
 
 class CStructVarString(CStruct):
@@ -80,3 +157,17 @@ class VarcharField(StructField):
         if isinstance(default, bytes):
             default = CStructVarString(text=default)
         StructField.__init__(self, idx, CStructVarString, default, **opts)
+
+
+class CStructCompactString(CStruct):
+    length = VarUIntField(0)
+    text = StringField(1, length='length')
+
+
+class CompactVarcharField(StructField):
+    """A `VarcharField` with the length stored as a `VarUIntField`."""
+
+    def __init__(self, idx, default='', **opts):
+        if isinstance(default, bytes):
+            default = CStructCompactString(text=default)
+        StructField.__init__(self, idx, CStructCompactString, default, **opts)
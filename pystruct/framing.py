@@ -0,0 +1,206 @@
+# -*- coding: utf-8
+"""
+Framing of record streams. Records are packed back to back into
+blocks of about `block_size` bytes, each written as a frame: a
+`FrameHeader` followed by the (optionally compressed) block::
+
+    with FrameWriter(stream, Message, compression='zlib') as writer:
+        for message in messages:
+            writer.write(message)
+
+    for message in FrameReader(stream, Message):
+        ...
+
+Any file-like object will do, e.g. a file or `socket.makefile()`.
+"""
+from __future__ import absolute_import
+import zlib
+
+from pystruct.common import IncompleteDataException, UnpackException
+from pystruct.fields.numeric import UIntField, UByteField
+from pystruct.struct import CStruct
+
+# compression methods, by their ids in the frame header
+COMPRESSION = {None: 0, 'zlib': 1, 'lzma': 2}
+
+
+class FrameHeader(CStruct):
+    size = UIntField(0)  # of the block, as written
+    count = UIntField(1)  # of the records in the block
+    raw_size = UIntField(2)  # of the block, decompressed
+    compression = UByteField(3)
+
+HEADER_SIZE = FrameHeader().packed_size()
+
+
+def compress(data, compression, level=None):
+    if compression == 'zlib':
+        return zlib.compress(data, 6 if level is None else level)
+    if compression == 'lzma':
+        import lzma
+        return lzma.compress(data, preset=level)
+    return data
+
+
+def decompress(data, method, size):
+    """
+    Decompress a block of `size` bytes. At most a byte more than that
+    is decompressed - a block, which turns out bigger (or smaller),
+    is an error.
+    """
+    # room for a byte more, to find out if there is more
+    # (and a limit of 0 would mean no limit at all)
+    if method == COMPRESSION['zlib']:
+        block = zlib.decompressobj().decompress(data, size + 1)
+    elif method == COMPRESSION['lzma']:
+        import lzma
+        decompressor = lzma.LZMADecompressor()
+        block = decompressor.decompress(data, size + 1)
+        if not decompressor.eof and len(block) == size:
+            raise UnpackException("Compressed block is truncated.")
+    elif method == COMPRESSION[None]:
+        block = data
+    else:
+        raise ValueError("Unknown compression method: {0}.".format(method))
+    if len(block) != size:
+        raise UnpackException("Block doesn't decompress to {0} bytes."
+                              .format(size))
+    return block
+
+
+def read_exactly(stream, size):
+    """
+    Read `size` bytes from the stream. Returns an empty string if
+    the stream ends right away, raises `IncompleteDataException`
+    if it ends later.
+    """
+    chunks = []
+    missing = size
+    while missing:
+        chunk = stream.read(missing)
+        if not chunk:
+            if missing == size:
+                return b''
+            raise IncompleteDataException("Unexpected end of stream.", missing)
+        chunks.append(chunk)
+        missing -= len(chunk)
+    return b''.join(chunks)
+
+
+class FrameWriter(object):
+    """
+    Writes records of structure `klass` to `stream` in frames. A frame
+    is written as soon as the records packed so far take `block_size`
+    bytes, and on `flush()`/`close()`. `compression` is `None`, 'zlib'
+    or 'lzma' (Python 3 only), `level` is passed on to the compressor.
+    """
+
+    def __init__(self, stream, klass, compression=None, block_size=65536,
+                 level=None):
+        if compression not in COMPRESSION:
+            raise ValueError("Unknown compression method: {0!r}."
+                             .format(compression))
+        if compression == 'lzma':
+            import lzma  # fail early, if it's not available
+        self.stream = stream
+        self.klass = klass
+        self.compression = compression
+        self.block_size = block_size
+        self.level = level
+        self._records = []
+        self._size = 0
+
+    def write(self, record):
+        data = record.pack()
+        self._records.append(data)
+        self._size += len(data)
+        if self._size >= self.block_size:
+            self.flush()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        """Write the pending records as a frame."""
+        if not self._records:
+            return
+        block = compress(b''.join(self._records), self.compression, self.level)
+        header = FrameHeader(size=len(block), count=len(self._records),
+                             raw_size=self._size,
+                             compression=COMPRESSION[self.compression])
+        self.stream.write(header.pack() + block)
+        self._records = []
+        self._size = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FrameReader(object):
+    """
+    Reads records of structure `klass` written by a `FrameWriter`.
+    Each block is read and decompressed at once, then all of its
+    records are unpacked together (see `CStruct.unpack_many`).
+    Iterate over the reader to get the records one by one.
+
+    Blocks bigger than `max_block_size` bytes (decompressed) aren't
+    read - a corrupt or a malicious header can't make the reader
+    allocate more than that.
+    """
+
+    def __init__(self, stream, klass, validate=False,
+                 max_block_size=16 * 1024 * 1024):
+        self.stream = stream
+        self.klass = klass
+        self.validate = validate
+        self.max_block_size = max_block_size
+
+    def read_frame(self):
+        """The records of the next frame, or `None` at the end of stream."""
+        data = read_exactly(self.stream, HEADER_SIZE)
+        if not data:
+            return None
+        header, _ = FrameHeader.unpack(data)
+        size = max(header.size, header.raw_size)
+        if size > self.max_block_size:
+            raise UnpackException("Block of {0} bytes is too big.".format(size))
+        block = read_exactly(self.stream, header.size)
+        if len(block) < header.size:
+            raise IncompleteDataException("Unexpected end of stream.",
+                                          header.size)
+        block = decompress(block, header.compression, header.raw_size)
+
+        # the records have to take the whole block, no more, no less
+        klass, count, validate = self.klass, header.count, self.validate
+        error = UnpackException("Block of {0} bytes doesn't hold {1} records."
+                                .format(len(block), count))
+        if klass._fixed_run is not None:
+            if count * klass._fixed_run.size != len(block):
+                raise error
+            return klass.unpack_many(block, count, validate=validate)
+
+        records, end = [], 0
+        try:
+            for _ in range(count):
+                record, end = klass.unpack(block, end, validate)
+                records.append(record)
+        except IncompleteDataException:
+            raise error
+        if end != len(block):
+            raise error
+        return records
+
+    def __iter__(self):
+        while True:
+            records = self.read_frame()
+            if records is None:
+                return
+            for record in records:
+                yield record
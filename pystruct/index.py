@@ -0,0 +1,191 @@
+# -*- coding: utf-8
+"""
+Random access to files of consecutive, variable-size records.
+"""
+from __future__ import absolute_import
+import array
+import mmap
+import os
+import struct
+import zlib
+
+from pystruct.common import IncompleteDataException
+from pystruct.utils import TypedArray
+
+INDEX_MAGIC = b'PSI2'
+# magic, size of an offset, number of bytes of the data file indexed,
+# inode of the data file and checksum of the indexed data (see `_checksum_of`)
+INDEX_HEADER = struct.Struct(str('<4sBQQI'))
+# bytes at the start and at the end of the indexed data, which are checked
+# to find out if the file was rewritten
+SAMPLE_SIZE = 4096
+
+try:
+    range_type = xrange
+except NameError:  # Python 3
+    range_type = range
+
+
+def _offset_code():
+    # 'Q' isn't available in Python 2 - but there 'L' is 64 bits wide
+    # on most 64-bit platforms
+    for code in ('Q', 'L'):
+        try:
+            if array.array(str(code)).itemsize == 8:
+                return code
+        except ValueError:
+            pass
+    return 'L'
+
+OFFSET_CODE = _offset_code()
+
+
+class RecordIndex(object):
+    """
+    Start offsets of the records of structure `klass` stored back to
+    back in the file at `path`. The file is scanned once, looking only
+    at the fields, which determine the size of each record, and the
+    offsets are saved to `index_path` (the data path with '.idx'
+    appended, by default). When opened again, only the data appended
+    to the file since then is scanned. An incomplete record at the end
+    of the file (e.g. one still being written) isn't indexed yet.
+
+    The index is built again if the file was replaced, truncated or
+    rewritten - as far as a checksum of the first and the last
+    `SAMPLE_SIZE` bytes of the indexed data tells. Records of a fixed
+    size aren't scanned (nor saved) at all - their offsets are computed.
+
+    Records are read from a memory map of the file::
+
+        with RecordIndex(Message, 'capture.bin') as index:
+            message = index.get(len(index) - 1)
+    """
+
+    def __init__(self, klass, path, index_path=None):
+        self.klass = klass
+        self.path = path
+        self.index_path = index_path or path + '.idx'
+        self.offsets = TypedArray(OFFSET_CODE)
+        # bytes of the data file covered by the offsets
+        self.end = 0
+        self._checksum = self._inode = None  # of the indexed data
+        self._saved = None  # number of offsets in the index file
+        self._file = open(path, 'rb')
+        self._map = None
+        if klass._fixed_run is None:
+            self._load()
+        self.update()
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                magic, itemsize, end, inode, checksum = INDEX_HEADER.unpack(
+                    f.read(INDEX_HEADER.size))
+                if magic != INDEX_MAGIC or itemsize != self.offsets.itemsize:
+                    return
+                offsets = TypedArray(OFFSET_CODE)
+                offsets.load(f.read())
+        except (IOError, struct.error):
+            return  # no index yet, or a broken one
+        self.offsets, self.end = offsets, end
+        self._inode, self._checksum = inode, checksum
+        self._saved = len(offsets)
+
+    def _checksum_of(self, end):
+        """Checksum of the start and the end of the first `end` bytes."""
+        data = self._map
+        head = data[:min(end, SAMPLE_SIZE)]
+        tail = data[max(0, end - SAMPLE_SIZE):end]
+        return zlib.crc32(tail, zlib.crc32(head)) & 0xffffffff
+
+    def update(self):
+        """Index the records appended to the file since the last update."""
+        if os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino:
+            # the file was replaced since it was opened
+            self._unmap()
+            self._file.close()
+            self._file = open(self.path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        size = stat.st_size
+
+        self._unmap()
+        # empty files can't be mapped
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if size else b''
+
+        run = self.klass._fixed_run
+        if run is not None:
+            # no need to look at the data at all
+            self.end = size // run.size * run.size
+            self.offsets = range_type(0, self.end, run.size)
+            return
+
+        if self._saved is not None and (stat.st_ino != self._inode
+                                        or size < self.end or self._checksum
+                                        != self._checksum_of(self.end)):
+            # the file was replaced or rewritten - start over
+            self.offsets, self.end = TypedArray(OFFSET_CODE), 0
+            self._saved = None
+
+        offset = self.end
+        skip, data = self.klass._skip, self._map
+        append = self.offsets.append
+        while offset < size:
+            try:
+                end = skip(data, offset)
+            except IncompleteDataException:
+                break
+            if end > size:
+                break  # skipping doesn't check the fixed-size parts
+            append(offset)
+            offset = end
+
+        if offset != self.end or self._saved is None:
+            self.end = offset
+            self._inode = stat.st_ino
+            self._checksum = self._checksum_of(offset)
+            self.save()
+
+    def save(self):
+        """Write the offsets to the index file."""
+        offsets = self.offsets
+        if self._saved is None or self._saved > len(offsets):
+            with open(self.index_path, 'wb') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, offsets.itemsize,
+                                          self.end, self._inode,
+                                          self._checksum))
+                f.write(offsets.packed())
+        else:
+            # only append the new offsets
+            with open(self.index_path, 'r+b') as f:
+                f.seek(INDEX_HEADER.size + self._saved * offsets.itemsize)
+                f.write(TypedArray(OFFSET_CODE, offsets[self._saved:]).packed())
+                f.truncate()
+                f.seek(0)
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, offsets.itemsize,
+                                          self.end, self._inode,
+                                          self._checksum))
+        self._saved = len(offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get(self, n, validate=False):
+        """Unpack the `n`-th record (see `CStruct.unpack`)."""
+        record, _ = self.klass.unpack(self._map, self.offsets[n], validate)
+        return record
+
+    def _unmap(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._map = None
+
+    def close(self):
+        self._unmap()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,265 @@
+# -*- coding: utf-8
+"""
+Compiled layout of a structure.
+
+Consecutive fields with a fixed format are grouped into a `FixedRun`,
+which packs and unpacks all of them with a single precompiled
+`struct.Struct`. Every other field gets its own `FieldStep`, which
+goes through the regular per-field path (constraints and all).
+"""
+from __future__ import absolute_import
+import struct
+from pystruct.common import IncompleteDataException
+from pystruct.utils import ItemWrapper, reserve
+
+
+def item_count(fmt):
+    """Number of items packed by the given format."""
+    fmt = str('<' + fmt)
+    return len(struct.unpack(fmt, b'\x00' * struct.calcsize(fmt)))
+
+
+class FieldStep(object):
+    """A single field with a data-dependent layout."""
+
+    def __init__(self, field):
+        self.field = field
+        self.fields = [field]
+
+    def before_pack(self, obj, offset):
+        return self.field.before_pack(obj, offset)
+
+    def pack_into(self, obj, buf, offset, base=0):
+        return self.field.pack_into(obj, buf, offset, base=base)
+
+    def unpack_into(self, values, obj, data, offset, validate=False):
+        value, offset = self.field.unpack(obj, data, offset, validate=validate)
+        values[self.field.name] = value
+        return offset
+
+    def unpack_reusing(self, values, obj, data, offset, scratch):
+        """`unpack_into`, reusing nested structures (see `UnpackScratch`)."""
+        spare = scratch.spare_for(self.field)
+        if spare is None:
+            return self.unpack_into(values, obj, data, offset)
+        value, offset = self.field.unpack_spare(obj, spare, data, offset,
+                                                scratch.nested_for(self.field))
+        values[self.field.name] = value
+        return offset
+
+    def skip(self, obj, data, offset):
+        return self.field.skip(obj, data, offset)
+
+    def patch_into(self, obj, buf, offset, names):
+        return self.field.pack_into(obj, buf, offset)
+
+
+class FixedRun(object):
+    """A run of fields, which always occupy the same number of bytes."""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.names = [field.name for field in fields]
+        self.format = ''.join(field.fixed_format() for field in fields)
+        self.struct = struct.Struct(str('<' + self.format))
+        self.size = self.struct.size
+
+        self.slices = []
+        start = 0
+        for field in fields:
+            stop = start + item_count(field.fixed_format())
+            self.slices.append((field, start, stop))
+            start = stop
+        # every field maps to exactly one item
+        self.simple = all(field.fixed_scalar and (stop - start) == 1
+                          for (field, start, stop) in self.slices)
+
+        # position and format of each field within the run
+        self.placement = {}
+        position = 0
+        for field in fields:
+            fmt = struct.Struct(str('<' + field.fixed_format()))
+            self.placement[field.name] = (field, position, fmt)
+            position += fmt.size
+
+    def flatten(self, obj):
+        """Items of all the fields in `obj`, ready to be packed."""
+        if self.simple:
+            return [getattr(obj, name) for name in self.names]
+        items = []
+        for field in self.fields:
+            items.extend(field.fixed_values(getattr(obj, field.name)))
+        return items
+
+    def unflatten(self, items, validate=False):
+        """Map unpacked items back to a dictionary of field values."""
+        if self.simple:
+            return dict(zip(self.names, items))
+        return dict((field.name, field.from_fixed(items[start:stop], validate))
+                    for (field, start, stop) in self.slices)
+
+    def unflatten_into(self, values, items, scratch):
+        """
+        `unflatten` into the `values` dictionary, with nested structures
+        decoded into spare instances (see `UnpackScratch`).
+        """
+        if self.simple:
+            values.update(zip(self.names, items))
+            return
+        for (field, start, stop) in self.slices:
+            spare = scratch.spare_for(field)
+            if spare is None:
+                values[field.name] = field.from_fixed(items[start:stop])
+            else:
+                values[field.name] = spare._refill(items[start:stop],
+                                                   scratch.nested_for(field))
+
+    def before_pack(self, obj, offset):
+        return self.size
+
+    def pack_into(self, obj, buf, offset, base=0):
+        reserve(buf, offset + self.size)
+        self.struct.pack_into(buf, offset, *self.flatten(obj))
+        return offset + self.size
+
+    def _unpack_items(self, data, offset):
+        try:
+            return self.struct.unpack_from(data, offset)
+        except struct.error:
+            raise IncompleteDataException(
+                "Not enough data for fields {0}.".format(', '.join(self.names)),
+                offset + self.size - len(data))
+
+    def unpack_into(self, values, obj, data, offset, validate=False):
+        items = self._unpack_items(data, offset)
+        values.update(self.unflatten(items, validate))
+        return offset + self.size
+
+    def unpack_reusing(self, values, obj, data, offset, scratch):
+        self.unflatten_into(values, self._unpack_items(data, offset), scratch)
+        return offset + self.size
+
+    def skip(self, obj, data, offset):
+        return offset + self.size
+
+    def patch_into(self, obj, buf, offset, names):
+        """Pack only the fields called `names` (the run starts at `offset`)."""
+        for name in names:
+            field, position, fmt = self.placement[name]
+            fmt.pack_into(buf, offset + position,
+                          *field.fixed_values(getattr(obj, name)))
+
+
+def compile_layout(fields):
+    """
+    Split the fields into steps. Returns a tuple of the steps and
+    a `FixedRun` of all the fields, if they all have a fixed format
+    (`None` otherwise).
+    """
+    steps = []
+    run = []
+    for field in fields:
+        if field.fixed_format() is not None:
+            run.append(field)
+            continue
+        if run:
+            steps.append(FixedRun(run))
+            run = []
+        steps.append(FieldStep(field))
+
+    if len(run) == len(fields):
+        whole = FixedRun(run)
+        return ([whole] if run else []), whole
+
+    if run:
+        steps.append(FixedRun(run))
+    return steps, None
+
+
+class UnpackScratch(object):
+    """
+    State of `CStruct.unpack_into`, which can be kept for the next call
+    (by a `StructPool`): the dictionary the values are decoded into,
+    the wrapper the fields look them up through and a spare instance
+    for each nested structure. A nested structure is decoded into the
+    spare, which then trades places with the current one - so once
+    warmed up, nothing is allocated and the instance stays as it was
+    if the data can't be unpacked.
+    """
+    __slots__ = ('values', 'context', '_spares', '_nested')
+
+    def __init__(self):
+        self.values = {}
+        self.context = ItemWrapper(self.values)
+        self._spares = {}
+        self._nested = {}  # the state of the nested structures
+
+    def spare_for(self, field):
+        """
+        The spare instance for the structure nested in `field`,
+        `None` if the field doesn't hold one, which could be reused.
+        """
+        klass = field.reusable_class()
+        if klass is None:
+            return None
+        spare = self._spares.get(field.name)
+        if spare is None:
+            spare = self._spares[field.name] = klass.__new__(klass)
+        return spare
+
+    def nested_for(self, field):
+        scratch = self._nested.get(field.name)
+        if scratch is None:
+            scratch = self._nested[field.name] = UnpackScratch()
+        return scratch
+
+    def swap(self, field, value, current):
+        """
+        If the new `value` of `field` is the spare, make the `current`
+        value the spare instead. Returns whether it was the spare.
+        """
+        if value is None or self._spares.get(field.name) is not value:
+            return False
+        self._spares[field.name] = current if type(current) is type(value) \
+            else None
+        return True
+
+
+class LazyValues(dict):
+    """
+    Field values of a structure, which are decoded from the buffer
+    the first time they are looked up. Offsets of the layout steps are
+    computed (by skipping over the preceding steps) only when needed.
+    """
+
+    def __init__(self, klass, data, offset):
+        dict.__init__(self)
+        self._layout = klass._layout
+        self._step_of = klass._step_of
+        self._data = data
+        self._offsets = [offset]
+        # constraints (e.g. a length stored in another field) look up
+        # values through this wrapper, so they get decoded on demand too
+        self._context = ItemWrapper(self)
+
+    def __missing__(self, name):
+        self._decode(self._step_of[name])
+        return dict.__getitem__(self, name)
+
+    def _start(self, index):
+        offsets = self._offsets
+        while len(offsets) <= index:
+            i = len(offsets) - 1
+            offsets.append(self._layout[i].skip(self._context, self._data,
+                                                offsets[i]))
+        return offsets[index]
+
+    def _decode(self, index):
+        end = self._layout[index].unpack_into(self, self._context,
+                                              self._data, self._start(index))
+        if len(self._offsets) == index + 1:
+            self._offsets.append(end)
+
+    def end(self):
+        """Offset just past the structure."""
+        return self._start(len(self._layout))
@@ -0,0 +1,198 @@
+# -*- coding: utf-8
+"""
+Opt-in profiling of packing and unpacking. While enabled, calls to the
+fields, constraints, fixed runs (see `pystruct.layout`) and structures
+are counted and timed, together with the number of bytes they packed
+or unpacked::
+
+    with profile() as profiler:
+        Message.unpack_many(data)
+    print(profiler.table())
+
+Nothing is instrumented unless a profiler is enabled - it's hooked in
+with `sys.setprofile`, so it only sees the thread that enabled it.
+Times are inclusive: a `StructField` includes the fields of the inner
+structure, a field includes its constraints.
+"""
+from __future__ import absolute_import
+import sys
+import timeit
+from contextlib import contextmanager
+
+from pystruct.constraints import Constraint
+from pystruct.fields.base import CField
+from pystruct.layout import FixedRun
+from pystruct.struct import CStruct
+
+# traced methods: name -> (argument with the start offset, what the
+# method returns: the 'end' offset, a (value, end) 'pair', the 'size'
+# or the packed 'bytes')
+FIELD_METHODS = {
+    'pack_into': ('offset', 'end'),
+    'unpack': ('pos', 'pair'),
+    'skip': ('pos', 'end'),
+    'before_pack': (None, 'size'),
+    'set_value': (None, None),
+}
+RUN_METHODS = {
+    'pack_into': ('offset', 'end'),
+    'unpack_into': ('offset', 'end'),
+}
+STRUCT_METHODS = {
+    'pack': (None, 'bytes'),
+    'pack_into': ('offset', 'end'),
+    'unpack': ('offset', 'pair'),
+}
+CONSTRAINT_METHODS = ('before_unpack', 'before_pack', 'pack',
+                      'on_value_set', 'on_values_set', 'match')
+
+
+def subclasses(klass):
+    """The class and all of its (currently defined) subclasses."""
+    result = [klass]
+    for sub in type.__subclasses__(klass):
+        result.extend(subclasses(sub))
+    return result
+
+
+def code_of(func):
+    func = getattr(func, '__func__', func)  # classmethod
+    return getattr(func, '__code__', None)
+
+
+class Profiler(object):
+    """
+    Collects the statistics. Each entry is keyed by a `(kind, name,
+    operation)` tuple, where kind is one of 'struct', 'field', 'run'
+    and 'constraint'. Fields are named `Struct.field`, constraints
+    by their class - all the constraints of a class are counted
+    together.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self._probes = None
+        self._stack = []
+        self._active = {}
+        # the profile function installed before (e.g. by cProfile)
+        self._previous = None
+
+    def _compile_probes(self):
+        probes = {}
+
+        def add(klass, methods, kind):
+            for (method, spec) in methods.items():
+                code = code_of(klass.__dict__.get(method))
+                if code is not None:
+                    probes[code] = (kind, method) + spec
+
+        for klass in subclasses(CField):
+            add(klass, FIELD_METHODS, 'field')
+        add(FixedRun, RUN_METHODS, 'run')
+        add(CStruct, STRUCT_METHODS, 'struct')
+        for klass in subclasses(Constraint):
+            for (method, func) in klass.__dict__.items():
+                op = [name for name in CONSTRAINT_METHODS
+                      if method.startswith(name)]
+                code = code_of(func)
+                if op and code is not None:
+                    probes[code] = ('constraint', op[0], None, None)
+        return probes
+
+    def enable(self):
+        if self._probes is None:
+            self._probes = self._compile_probes()
+        self._previous = sys.getprofile()
+        sys.setprofile(self._trace)
+
+    def disable(self):
+        sys.setprofile(self._previous)
+        self._previous = None
+        del self._stack[:]
+        self._active.clear()
+
+    def _label(self, kind, local):
+        if kind == 'field':
+            field = local['self']
+            if field.owner is not None:
+                return '{0}.{1}'.format(field.owner.__name__, field.name)
+            return str(field.name)
+        if kind == 'run':
+            run = local['self']
+            return '{0}.{1}'.format(run.fields[0].owner.__name__,
+                                    '+'.join(run.names))
+        if kind == 'struct':
+            klass = local.get('cls') or type(local['self'])
+            return klass.__name__
+        return type(local['self']).__name__
+
+    def _trace(self, frame, event, arg):
+        if event == 'call':
+            probe = self._probes.get(frame.f_code)
+            if probe is None:
+                return
+            kind, op, start_arg, result = probe
+            local = frame.f_locals
+            key = (kind, self._label(kind, local), op)
+            # a method calling its base class version is counted once
+            if self._active.get(key):
+                return
+            self._active[key] = True
+            start = local.get(start_arg) if start_arg else None
+            self._stack.append((frame, key, start, result,
+                                timeit.default_timer()))
+        elif event == 'return' and self._stack \
+          and self._stack[-1][0] is frame:
+            now = timeit.default_timer()
+            _, key, start, result, started = self._stack.pop()
+            self._active[key] = False
+            entry = self.stats.get(key)
+            if entry is None:
+                entry = self.stats[key] = [0, 0.0, 0]
+            entry[0] += 1
+            entry[1] += now - started
+            entry[2] += self._bytes(start, result, arg)
+
+    @staticmethod
+    def _bytes(start, result, value):
+        if value is None or result is None:
+            return 0  # also when an exception was raised
+        if result == 'pair':
+            return value[1] - start
+        if result == 'end':
+            return value - start
+        if result == 'size':
+            return value
+        return len(value)
+
+    def rows(self):
+        """
+        The statistics as a list of `(kind, name, operation, calls,
+        seconds, bytes)` tuples, the most time consuming first.
+        """
+        rows = [key + tuple(entry) for (key, entry) in self.stats.items()]
+        rows.sort(key=lambda row: row[4], reverse=True)
+        return rows
+
+    def table(self):
+        """The statistics formatted as a plain text table."""
+        lines = ["{0:<10} {1:<30} {2:<13} {3:>8} {4:>10} {5:>10}".format(
+            "kind", "name", "operation", "calls", "time [ms]", "bytes")]
+        for (kind, name, op, calls, seconds, size) in self.rows():
+            lines.append("{0:<10} {1:<30} {2:<13} {3:>8} {4:>10.3f} {5:>10}"
+                         .format(kind, name, op, calls, seconds * 1000, size))
+        return '\n'.join(lines)
+
+
+@contextmanager
+def profile(profiler=None):
+    """
+    Profile the code in the `with` block, using the given `Profiler`
+    (to accumulate results of several blocks) or a new one.
+    """
+    profiler = profiler or Profiler()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
@@ -1,9 +1,21 @@
 # -*- coding: utf-8
+from pystruct.common import IncompleteDataException, UnpackException
+from pystruct.constraints import OffsetConstraint
 from pystruct.fields.base import CField
-from pystruct.utils import ItemWrapper
+from pystruct.layout import compile_layout, FixedRun, LazyValues, UnpackScratch
+from pystruct.utils import (ItemWrapper, PackBuffer, buffer_slice, reserve,
+                            to_bytes)
+
+
+# names of fields changed since an instance was unpacked - none yet
+UNCHANGED = frozenset()
 
 
 class StructMetaclass(type):
+    # per-instance attributes, other than field values
+    INSTANCE_STATE = ('_lazy_values', '_dirty_fields')
+    # ... and of frozen structures
+    FROZEN_STATE = ('_packed',)
 
     def __new__(cls, name, bases, cdict):
         fields = []
@@ -18,31 +30,261 @@ class StructMetaclass(type):
             else:
                 ndict[field_name] = field_value
 
-        klass = type.__new__(cls, str(name), bases, ndict)
         fields.sort(key=lambda item: item.idx)
 
+        # options, inherited from the base classes
+        meta = cdict.get('Meta') or getattr(bases[0], 'Meta', None)
+        if getattr(meta, 'slots', False) and '__slots__' not in cdict:
+            ndict['__slots__'] = cls.slots_for(bases, fields)
+
+        klass = type.__new__(cls, str(name), bases, ndict)
+        for field in fields:
+            field.owner = klass
+
         order = getattr(klass, '_field_order', [])
         order = order + fields
         setattr(klass, '_field_order', order)
+
+        # precompile runs of fixed-size fields
+        klass._layout, klass._fixed_run = compile_layout(order)
+        klass._step_of = dict((f.name, index)
+                              for (index, step) in enumerate(klass._layout)
+                              for f in step.fields)
+        # without fields updating other fields, packing takes one pass
+        klass._pack_fixups = any(f.pack_fixups() for f in order)
+        if getattr(klass, '_frozen', False):
+            cls.freeze(klass, order)
         return klass
 
+    @classmethod
+    def freeze(cls, klass, fields):
+        """
+        Make all the fields of `klass` (inherited ones included) read-only
+        once an instance is built - see `FrozenCStruct`.
+        """
+        if klass._pack_fixups:
+            raise ValueError("Frozen structure {0} can't have fields updated "
+                             "while packing.".format(klass.__name__))
+        for field in fields:
+            # the packed form is reused wherever the structure is packed,
+            # so its fields can't depend on the position
+            if any(isinstance(c, OffsetConstraint) for c in field.constraints):
+                raise ValueError("Field {0} of frozen structure {1} has an "
+                                 "explicit offset.".format(field.name,
+                                                           klass.__name__))
+            for inner in field.struct_classes():
+                if not getattr(inner, '_frozen', False):
+                    raise ValueError(
+                        "Field {0} of frozen structure {1} holds {2}, which "
+                        "isn't frozen.".format(field.name, klass.__name__,
+                                               inner.__name__))
+            setattr(klass, field.name, property(cls.getter_for(field),
+                                                cls.frozen_setter_for(field)))
+
+    @classmethod
+    def slots_for(cls, bases, fields):
+        """
+        Slots for the storage of field values (and other instance state),
+        which aren't provided by the base classes already.
+        """
+        inherited = set()
+        for base in bases:
+            for klass in base.__mro__:
+                inherited.update(klass.__dict__.get('__slots__', ()))
+        names = ['_' + field.name for field in fields]
+        names.extend(cls.INSTANCE_STATE)
+        if any(getattr(base, '_frozen', False) for base in bases):
+            names.extend(cls.FROZEN_STATE)
+        return tuple(name for name in names if name not in inherited)
+
     @staticmethod
     def getter_for(field):
+        storage = '_' + field.name
+
         def getter(self):
-            return field.get_value(self, getattr(self, '_' + field.name))
+            try:
+                value = getattr(self, storage)
+            except AttributeError:
+                value = self._load(field)
+            return field.get_value(self, value)
         return getter
 
     @staticmethod
     def setter_for(field):
+        name = field.name
+
         def setter(self, v):
-            return setattr(self, '_' + field.name, field.set_value(self, v))
+            setattr(self, '_' + name, field.set_value(self, v))
+            # remember the change (see `CStruct.patch_into`)
+            dirty = getattr(self, '_dirty_fields', None)
+            if dirty is not None:
+                self._dirty_fields = dirty.union((name,))
         return setter
 
+    @staticmethod
+    def frozen_setter_for(field):
+        setter = StructMetaclass.setter_for(field)
+
+        def frozen_setter(self, v):
+            # `_packed` is set once the instance is complete
+            if hasattr(self, '_packed'):
+                raise AttributeError("Can't set field {0}, {1} is frozen."
+                                     .format(field.name, type(self).__name__))
+            setter(self, v)
+        return frozen_setter
+
+
+CStructBase = StructMetaclass('CStructBase', (object,), {'__slots__': ()})
+
+
+class StructReader(object):
+    """
+    Reads a single structure incrementally, without any I/O of its own.
+    `needed` tells how many bytes to `feed` next - never more than the
+    structure takes: whole fixed parts at once, length-dependent parts
+    as soon as their length is known. Feeding more than that raises
+    `ValueError`. When `needed` drops to zero, the instance is available
+    as `result`.
+    """
+
+    def __init__(self, klass, validate=False):
+        self._klass = klass
+        self._validate = validate
+        self._chunks = []
+        self.result = None
+        self._advance()
+
+    def _advance(self):
+        data = b''.join(self._chunks)
+        self._chunks = [data]
+        try:
+            self.result, _ = self._klass.unpack(data, validate=self._validate)
+            self.needed = 0
+        except IncompleteDataException as e:
+            self.needed = e.needed
+
+    def feed(self, data):
+        if not self.needed:
+            raise ValueError("The structure is complete.")
+        if len(data) > self.needed:
+            # the rest would belong to whatever follows the structure
+            raise ValueError("Got {0} bytes, only {1} needed."
+                             .format(len(data), self.needed))
+        self._chunks.append(data)
+        if len(data) < self.needed:
+            # nothing new can be unpacked before the rest arrives
+            self.needed -= len(data)
+        else:
+            self._advance()
+
+
+class StructPool(object):
+    """
+    Instances of a structure kept for reuse by `unpack`, which fills
+    them with `CStruct.unpack_into`. Up to `size` released instances
+    are kept. Structures nested in a released instance are reused too -
+    don't keep references to them either. Not thread-safe - use a pool
+    per thread.
+    """
+
+    def __init__(self, klass, size=64):
+        self._klass = klass
+        self._size = size
+        self._free = []
+        # shared by all the instances - only one is unpacked at a time
+        self._scratch = UnpackScratch()
+
+    def acquire(self):
+        """
+        A released instance, or a new one if there's none. Its fields
+        are undefined until it's unpacked into.
+        """
+        if self._free:
+            return self._free.pop()
+        return self._klass.__new__(self._klass)
+
+    def release(self, instance):
+        """Give the instance back, once it's no longer used."""
+        if len(self._free) < self._size:
+            self._free.append(instance)
+
+    def unpack(self, data, offset=0, validate=False):
+        """Like `CStruct.unpack`, but with a pooled instance."""
+        instance = self.acquire()
+        try:
+            offset = self._klass._unpack_into(instance, data, offset, validate,
+                                              scratch=self._scratch)
+        except Exception:
+            self.release(instance)
+            raise
+        return instance, offset
+
+
+class Dispatcher(object):
+    """
+    Unpacks one of several structures, picking the type by the prefix
+    of its first field - with a dictionary lookup per distinct prefix
+    length, instead of trying the structures one by one. Longer
+    prefixes take precedence; an empty prefix matches anything.
+    """
+
+    def __init__(self, structs):
+        self.structs = tuple(structs)
+        tables = {}
+        for klass in self.structs:
+            prefix = klass._prefix()
+            if prefix is None:
+                raise ValueError("Structure {0} has no prefix to dispatch on."
+                                 .format(klass.__name__))
+            table = tables.setdefault(len(prefix), {})
+            if prefix in table:
+                raise ValueError("Structures {0} and {1} have the same prefix."
+                                 .format(table[prefix].__name__, klass.__name__))
+            table[prefix] = klass
+        self._tables = sorted(tables.items(), reverse=True)
+
+    def klass_for(self, data, offset=0):
+        """
+        The structure at `offset` in `data`. Raises `UnpackException`
+        if none of them matches.
+        """
+        available = len(data) - offset
+        for (length, table) in self._tables:
+            key = data[offset:offset + length]
+            if length > available:
+                # the data might end in the middle of a prefix
+                key = to_bytes(key)
+                if any(prefix.startswith(key) for prefix in table):
+                    raise IncompleteDataException(
+                        "Data ends within the prefix.", length - available)
+                continue
+            klass = table.get(to_bytes(key))
+            if klass is not None:
+                return klass
+        raise UnpackException("No structure matches the data at offset {0}."
+                              .format(offset))
 
-CStructBase = StructMetaclass('CStructBase', (object,), {})
+    def unpack(self, data, offset=0, validate=False):
+        """Unpack the matching structure - see `CStruct.unpack`."""
+        return self.klass_for(data, offset).unpack(data, offset, validate)
 
 
 class CStruct(CStructBase):
+    # values not decoded yet (see `unpack_lazy`)
+    _lazy_values = None
+    # names of the fields changed since unpacking, `None` if the changes
+    # aren't tracked (instances created from scratch or unpacked without
+    # `track_changes`) - set per instance only once tracking starts
+    _dirty_fields = None
+    # see `FrozenCStruct`
+    _frozen = False
+
+    # instances of subclasses keep a `__dict__`, unless they opt in
+    # for `__slots__` with::
+    #
+    #   class Meta:
+    #       slots = True
+    __slots__ = ()
 
     def __init__(self, **kwargs):
         for field in self._field_order:
@@ -51,35 +293,496 @@ class CStruct(CStructBase):
             raise ValueError("Unresolved fields: {0!r}".format(kwargs.keys()))
 
     def _before_pack(self, offset=0):
-        for field in self._field_order:
-            offset += field.before_pack(self, offset)
+        for step in self._layout:
+            offset += step.before_pack(self, offset)
         return offset
 
-    def _pack(self, off=0):
-        s = b''
-        for field in self._field_order:
-            data = field.pack(self, off)
-            off += len(data)
-            s += data
-        return s
+    def _pack_fields(self, buf, offset=0, base=0):
+        # positions of fields (checked by offset constraints) are relative
+        # to `base` - where the packed data starts in the buffer
+        for step in self._layout:
+            offset = step.pack_into(self, buf, offset, base)
+        return offset
+
+    # packs the structure as part of a larger whole (a nested structure,
+    # a batch) - overridden by `FrozenCStruct` to reuse the packed form
+    _pack_into = _pack_fields
+
+    def packed_size(self, offset=0):
+        """
+        Number of bytes the structure takes when packed at `offset`.
+        Constant for structures of fixed-size fields only.
+        """
+        run = self._fixed_run
+        if run is not None:
+            return run.size
+        return self._before_pack(offset) - offset
+
+    def pack_into(self, buf, offset=0):
+        """
+        Pack the structure into a writable buffer (a `bytearray`,
+        a `memoryview`, etc.), starting at `offset`. Returns the offset
+        just past the packed data.
+        """
+        if self._pack_fixups:
+            self._before_pack(offset)
+        return self._pack_fields(buf, offset)
 
     def pack(self, offset=0):
-        self._before_pack(offset)
-        return self._pack(offset)
+        run = self._fixed_run
+        if run is not None:
+            return run.struct.pack(*run.flatten(self))
+
+        # the buffer grows as the fields are packed
+        if self._pack_fixups:
+            self._before_pack(offset)
+        buf = PackBuffer()
+        self._pack_fields(buf, 0, -offset)
+        return bytes(buf)
 
     @classmethod
-    def unpack(cls, data, offset=0):
+    def unpack(cls, data, offset=0, validate=False, fields=None,
+               track_changes=False):
+        """
+        Unpack the structure at `offset` in `data`. Returns the instance
+        and the offset just past it. Decoded values are stored without
+        running the field constraints again, unless `validate` is set
+        (use it for untrusted input).
+
+        With `fields` (a sequence of field names) only those fields are
+        decoded and set on the instance. The rest is skipped over,
+        decoding only what their size depends on (e.g. length fields).
+
+        With `track_changes` the fields set from now on are recorded,
+        so that `patch_into` can write only those back to `data`.
+        """
+        if fields is not None:
+            return cls._unpack_fields(data, offset, fields, validate,
+                                      track_changes)
+
         dict = {}
         dp = ItemWrapper(dict)
 
-        for field in cls._field_order:
-            value, next_offset = field.unpack(dp, data, offset)
-            dict[field.name] = value
-            offset = next_offset
+        for step in cls._layout:
+            offset = step.unpack_into(dict, dp, data, offset, validate)
 
-        instance = cls(**dict)
+        instance = cls._from_values(dict, validate)
+        if track_changes:
+            instance._clear_changes()
         return instance, offset
 
+    @classmethod
+    def unpack_into(cls, instance, data, offset=0, validate=False,
+                    track_changes=False):
+        """
+        Unpack the structure at `offset` in `data` into an existing
+        `instance` of the class, replacing the values of all its fields,
+        instead of creating a new one (see also `pool`). Wrappers of
+        arrays (other than arrays of numbers) are kept and given the new
+        items. Nested structures are decoded into spare instances, which
+        then replace the current ones - those become the spares of the
+        next call of a `StructPool`. The instance isn't changed if
+        the data can't be unpacked. Returns the offset just past the
+        structure. `validate` and `track_changes` work as in `unpack`.
+        """
+        return cls._unpack_into(instance, data, offset, validate,
+                                track_changes, UnpackScratch())
+
+    @classmethod
+    def _unpack_into(cls, instance, data, offset=0, validate=False,
+                     track_changes=False, scratch=None):
+        if not isinstance(instance, cls) or instance._frozen:
+            raise ValueError("Can't unpack {0} into {1!r}."
+                             .format(cls.__name__, instance))
+        values, context = scratch.values, scratch.context
+        values.clear()
+        for step in cls._layout:
+            if validate:
+                offset = step.unpack_into(values, context, data, offset, True)
+            else:
+                offset = step.unpack_reusing(values, context, data, offset,
+                                             scratch)
+        instance._assign(values, scratch, validate, track_changes)
+        values.clear()  # don't keep the values alive
+        return offset
+
+    def _refill(self, items, scratch):
+        """
+        Replace the values of the fields with `items` unpacked by the
+        `FixedRun` of the whole structure. Returns the instance.
+        """
+        values = scratch.values
+        values.clear()
+        self._fixed_run.unflatten_into(values, items, scratch)
+        self._assign(values, scratch)
+        values.clear()
+        return self
+
+    def _assign(self, values, scratch, validate=False, track_changes=False):
+        """Set all the fields to the unpacked `values` (see `unpack_into`)."""
+        # slots of instance state may be unset (see `StructPool.acquire`)
+        if getattr(self, '_lazy_values', None) is not None:
+            self._lazy_values = None  # don't keep the old data around
+        for field in self._field_order:
+            value = values[field.name]
+            if validate:
+                setattr(self, field.name, value)
+                continue
+            storage = '_' + field.name
+            current = getattr(self, storage, None)
+            if scratch.swap(field, value, current):
+                pass  # decoded into the spare instance already
+            elif field.reuses_value:
+                value = field.reuse_value(self, current, value)
+            else:
+                value = field.set_trusted_value(self, value)
+            setattr(self, storage, value)
+        if track_changes:
+            self._clear_changes()
+        elif getattr(self, '_dirty_fields', None) is not None:
+            self._dirty_fields = None  # the old changes don't apply
+
+    @classmethod
+    def pool(cls, size=64):
+        """
+        A `StructPool` of instances of the structure to unpack into::
+
+            messages = Message.pool()
+            while offset < len(data):
+                message, offset = messages.unpack(data, offset)
+                handle(message)
+                messages.release(message)
+        """
+        return StructPool(cls, size)
+
+    @classmethod
+    def _unpack_fields(cls, data, offset, fields, validate=False,
+                       track_changes=False):
+        unknown = set(fields).difference(cls._step_of)
+        if unknown:
+            raise ValueError("Unknown fields: {0!r}".format(sorted(unknown)))
+
+        values = LazyValues(cls, data, offset)
+        instance = cls.__new__(cls)
+        for field in cls._field_order:
+            if field.name not in fields:
+                continue
+            if validate:
+                setattr(instance, field.name, values[field.name])
+            else:
+                setattr(instance, '_' + field.name,
+                        field.set_trusted_value(instance, values[field.name]))
+        if track_changes:
+            instance._clear_changes()
+
+        end = values.end()
+        if end > len(data):
+            # skipping doesn't check the size of fixed-size parts
+            raise IncompleteDataException(
+                "Not enough data for {0}.".format(cls.__name__),
+                end - len(data))
+        return instance, end
+
+    @classmethod
+    def pack_many(cls, records):
+        """
+        Pack instances of the structure back to back into a single
+        byte string - same as joining their `pack()` results.
+        """
+        run = cls._fixed_run
+        if run is not None:
+            pack, flatten = run.struct.pack, run.flatten
+            return b''.join([pack(*flatten(record)) for record in records])
+        if cls._pack_fixups:
+            # offsets stored in fields are relative to each record
+            return b''.join([record.pack() for record in records])
+
+        buf = PackBuffer()
+        offset = 0
+        for record in records:
+            # positions of the fields are relative to the record
+            offset = record._pack_into(buf, offset, offset)
+        return bytes(buf)
+
+    @classmethod
+    def unpack_many(cls, data, count=None, offset=0, validate=False,
+                    track_changes=False):
+        """
+        Unpack `count` consecutive structures from `data`, starting at
+        `offset` (by default, as many as there are up to the end of
+        the data). Returns a list of instances. `validate` and
+        `track_changes` work as in `unpack`.
+        """
+        run = cls._fixed_run
+        if run is None:
+            records = []
+            while (offset < len(data)) if count is None \
+              else (len(records) < count):
+                record, offset = cls.unpack(data, offset, validate,
+                                            track_changes=track_changes)
+                records.append(record)
+            return records
+
+        if count is None:
+            # a partial structure at the end is an error
+            count = -(-(len(data) - offset) // run.size)
+        end = offset + count * run.size
+        if end > len(data):
+            raise IncompleteDataException(
+                "Not enough data for {0} structures.".format(count),
+                end - len(data))
+
+        iter_unpack = getattr(run.struct, 'iter_unpack', None)
+        if iter_unpack is not None:
+            rows = iter_unpack(buffer_slice(data, offset, end))
+        else:  # Python 2
+            unpack_from = run.struct.unpack_from
+            rows = (unpack_from(data, start)
+                    for start in range(offset, end, run.size))
+        unflatten, build = run.unflatten, cls._from_values
+        records = [build(unflatten(row, validate), validate) for row in rows]
+        if track_changes:
+            for record in records:
+                record._clear_changes()
+        return records
+
+    def _changes(self):
+        """
+        Names of the fields changed since unpacking, including nested
+        structures changed in place, or `None` if that's not known.
+        """
+        dirty = getattr(self, '_dirty_fields', None)
+        if dirty is None:
+            return None
+        changed = set(dirty)
+        for field in self._field_order:
+            value = getattr(self, '_' + field.name, None)
+            if isinstance(value, CStruct) and value._changes() != set():
+                changed.add(field.name)
+        return changed
+
+    def _clear_changes(self):
+        self._dirty_fields = UNCHANGED
+        for field in self._field_order:
+            value = getattr(self, '_' + field.name, None)
+            if isinstance(value, CStruct):
+                value._clear_changes()
+
+    def patch_into(self, buf, offset=0):
+        """
+        Write the changes made to the structure since it was unpacked
+        from `buf` at `offset` (with `track_changes`) back to the buffer.
+        Only the changed fields are packed, as long as their size didn't
+        change - then the whole structure is packed again (a `bytearray`
+        is resized as needed, other buffers raise `ValueError`). Instances
+        created from scratch or unpacked without `track_changes` are
+        packed whole the first time. Items of arrays changed in place
+        aren't tracked - assign the array to the field again. Returns
+        the offset just past the structure.
+        """
+        changed = self._changes()
+        if changed is None or self._pack_fixups:
+            return self._repack(buf, offset)
+
+        positions = LazyValues(type(self), buf, offset)
+        patches = []
+        for (index, step) in enumerate(self._layout):
+            names = [f.name for f in step.fields if f.name in changed]
+            if not names:
+                continue
+            start = positions._start(index)
+            if not isinstance(step, FixedRun) and step.before_pack(self, start) \
+              != positions._start(index + 1) - start:
+                return self._repack(buf, offset)
+            patches.append((step, start, names))
+
+        end = positions.end()
+        for (step, start, names) in patches:
+            step.patch_into(self, buf, start, names)
+        self._clear_changes()
+        return end
+
+    def _repack(self, buf, offset):
+        """Replace the structure at `offset` in `buf` with a new version."""
+        end = self._skip(buf, offset)
+        data = self.pack(offset)
+        if len(data) != end - offset and not isinstance(buf, bytearray):
+            raise ValueError("The size of the structure changed, "
+                             "the buffer can't be resized.")
+        buf[offset:end] = data
+        self._clear_changes()
+        return offset + len(data)
+
+    @classmethod
+    def _prefix(cls):
+        """The prefix, which the structure always starts with, or `None`."""
+        if not cls._field_order:
+            return None
+        first = cls._field_order[0]
+        for c in first.constraints:
+            if getattr(c, 'keyword', None) == 'prefix' \
+              and c.keyword not in first.ommit:
+                return c.prefix
+        return None
+
+    @staticmethod
+    def dispatch(structs):
+        """
+        A `Dispatcher` unpacking any of the given structures::
+
+            messages = CStruct.dispatch([Ping, Pong, Data])
+            message, offset = messages.unpack(data)
+        """
+        return Dispatcher(structs)
+
+    @classmethod
+    def _from_values(cls, values, validate=False):
+        """Create an instance from a dictionary of unpacked values."""
+        if validate:
+            return cls(**values)
+        instance = cls.__new__(cls)
+        for field in cls._field_order:
+            setattr(instance, '_' + field.name,
+                    field.set_trusted_value(instance, values[field.name]))
+        return instance
+
+    @classmethod
+    def iter_unpack(cls, fileobj, buffer_size=65536, validate=False):
+        """
+        Unpack consecutive structures from a file-like object (anything
+        with a `read(size)` method, e.g. a file or `socket.makefile()`),
+        or a socket, yielding the instances one by one. Structures
+        crossing a chunk boundary are reassembled, so memory use doesn't
+        depend on the size of the stream. Fields spanning "the rest of
+        the data" (length=-1) don't make sense here, as they only see
+        the data read so far. `validate` works as in `unpack`.
+
+        Streams with a `read1(size)` (buffered files) or `recv(size)`
+        (sockets) method are read in chunks of up to `buffer_size` bytes,
+        whatever is available. Others are read by as much as the next
+        structure needs - a `read` waiting for all the bytes asked for
+        (e.g. `socket.makefile()`) would wait for the following
+        structures to arrive too.
+        """
+        read = getattr(fileobj, 'read1', None) \
+          or getattr(fileobj, 'recv', None)
+        if read is None:
+            read, buffer_size = fileobj.read, 0
+        try:
+            cls.unpack(b'')
+            first = 1
+        except IncompleteDataException as e:
+            first = e.needed  # the least a structure takes
+
+        data, offset = b'', 0
+        eof = False
+        while True:
+            needed = first
+            if offset < len(data):
+                try:
+                    instance, end = cls.unpack(data, offset, validate)
+                except IncompleteDataException as e:
+                    if eof:
+                        raise
+                    needed = e.needed
+                else:
+                    yield instance
+                    offset = end
+                    continue
+            elif eof:
+                return
+
+            chunk = read(max(buffer_size, needed))
+            eof = not chunk
+            data, offset = data[offset:] + chunk, 0
+
+    @classmethod
+    def reader(cls, validate=False):
+        """
+        A `StructReader` for this structure. Use it to read from
+        non-blocking streams, e.g. with asyncio::
+
+            reader = Message.reader()
+            while reader.needed:
+                reader.feed(await stream.readexactly(reader.needed))
+            message = reader.result
+        """
+        return StructReader(cls, validate)
+
+    @classmethod
+    def read_from(cls, stream, validate=False):
+        """
+        Read a single structure from a blocking file-like object,
+        consuming exactly the bytes, which belong to it.
+        """
+        reader = StructReader(cls, validate)
+        while reader.needed:
+            data = stream.read(reader.needed)
+            if not data:
+                raise IncompleteDataException("Unexpected end of stream.",
+                                              reader.needed)
+            reader.feed(data)
+        return reader.result
+
+    def write_to(self, stream):
+        """
+        Write the packed structure to a file-like object (or anything
+        with a `write()` method, like asyncio's `StreamWriter`).
+        """
+        stream.write(self.pack())
+
+    @classmethod
+    def unpack_lazy(cls, data, offset=0, track_changes=False):
+        """
+        Unpack the structure at `offset`, but decode each field only
+        when it's accessed for the first time. The instance keeps
+        a reference to `data`, which must not change in the meantime.
+        Unlike `unpack`, only the instance is returned. `track_changes`
+        works as in `unpack`.
+        """
+        instance = cls.__new__(cls)
+        instance._lazy_values = LazyValues(cls, data, offset)
+        if track_changes:
+            instance._clear_changes()
+        return instance
+
+    @classmethod
+    def numpy_dtype(cls):
+        """
+        NumPy structured dtype with the same layout as the structure.
+        Raises `ValueError` if any of the fields has a variable size.
+        """
+        import numpy
+        if '_numpy_dtype' not in cls.__dict__:
+            cls._numpy_dtype = numpy.dtype([(str(field.name), field.numpy_dtype())
+                                            for field in cls._field_order])
+        return cls._numpy_dtype
+
+    @classmethod
+    def unpack_array(cls, data, count=-1, offset=0):
+        """
+        View `count` consecutive structures in `data` (all of them by
+        default), starting at `offset`, as a NumPy record array. Nothing
+        is copied - the array shares memory with `data`. No constraints
+        (e.g. prefixes) are checked.
+        """
+        import numpy
+        return numpy.frombuffer(data, cls.numpy_dtype(), count, offset)
+
+    @classmethod
+    def _skip(cls, data, offset=0):
+        """Offset just past the structure at `offset`."""
+        return LazyValues(cls, data, offset).end()
+
+    def _load(self, field):
+        """Decode the value of a lazily unpacked field."""
+        lazy_values = getattr(self, '_lazy_values', None)
+        if lazy_values is None:
+            raise AttributeError(field.name)
+        value = field.set_trusted_value(self, lazy_values[field.name])
+        setattr(self, '_' + field.name, value)
+        return value
+
     def __field_value(self, field, default=None):
         return field.get_value(self, getattr(self, '_' + field.name, default))
 
@@ -89,3 +792,83 @@ class CStruct(CStructBase):
             for field in self._field_order)
         buf += ")"
         return buf
+
+
+class FrozenCStruct(CStruct):
+    """
+    A structure, which can't be changed once it's created (or unpacked).
+    It's packed only once - the result is reused by `pack`, `pack_into`
+    and by structures, which contain it. Instances compare equal when
+    they're of the same type and pack to the same bytes, and can be
+    used as dictionary keys.
+
+    Nested structures must be frozen as well and arrays are kept
+    as tuples. Fields updated while packing or depending on the position
+    (offsets - explicit or stored in other fields) aren't supported,
+    and neither is reusing instances (`unpack_into`).
+    """
+    _frozen = True
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        CStruct.__init__(self, **kwargs)
+        self._packed = None
+
+    @classmethod
+    def _from_values(cls, values, validate=False):
+        instance = super(FrozenCStruct, cls)._from_values(values, validate)
+        instance._packed = None
+        return instance
+
+    @classmethod
+    def pool(cls, size=64):
+        raise TypeError("Frozen structures can't be unpacked into.")
+
+    @classmethod
+    def _unpack_fields(cls, data, offset, fields, validate=False,
+                       track_changes=False):
+        instance, end = super(FrozenCStruct, cls)._unpack_fields(
+            data, offset, fields, validate, track_changes)
+        instance._packed = None
+        return instance, end
+
+    @classmethod
+    def unpack_lazy(cls, data, offset=0, track_changes=False):
+        instance = super(FrozenCStruct, cls).unpack_lazy(data, offset,
+                                                         track_changes)
+        instance._packed = None
+        return instance
+
+    def pack(self, offset=0):
+        packed = self._packed
+        if packed is None:
+            packed = self._packed = CStruct.pack(self, offset)
+        return packed
+
+    def packed_size(self, offset=0):
+        return len(self.pack())
+
+    def _before_pack(self, offset=0):
+        return offset + len(self.pack())
+
+    def _pack_into(self, buf, offset=0, base=0):
+        data = self.pack()
+        end = offset + len(data)
+        # (assigning the slice would resize a `bytearray`)
+        reserve(buf, end)
+        buf[offset:end] = data
+        return end
+
+    pack_into = _pack_into
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self.pack() == other.pack()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(self.pack())
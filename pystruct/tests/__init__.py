@@ -1,3 +1,14 @@
-from pystruct.tests.test_numeric import NumericFieldTest
+from pystruct.tests.test_numeric import NumericFieldTest, VarIntFieldTest
 from pystruct.tests.test_strings import StringFieldTest
-from pystruct.tests.test_complex import ArrayFieldTest, StructFieldTest
+from pystruct.tests.test_complex import (ArrayFieldTest, StructFieldTest,
+                                        UnionFieldTest)
+from pystruct.tests.test_struct import (LazyUnpackTest, ProjectionTest,
+                                       PackTest, PatchTest,
+                                       IterUnpackTest, BatchTest,
+                                       DispatchTest, StreamReadTest,
+                                       NumpyTest, ThreadSafetyTest, SlotsTest,
+                                       FrozenTest, UnpackIntoTest)
+from pystruct.tests.test_benchmarks import BenchmarkTest
+from pystruct.tests.test_profiling import ProfilingTest
+from pystruct.tests.test_index import RecordIndexTest
+from pystruct.tests.test_framing import FramingTest
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from pystruct.utils import unittest
+
+from pystruct.benchmarks import compare
+from pystruct.benchmarks.cases import CASES
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def testBaselines(self):
+        # the baselines have to do the same job as the structures
+        for case in CASES:
+            records = [case.make(i) for i in range(3)]
+            data = b''.join(record.pack() for record in records)
+            self.assertEqual(b''.join(case.pack(r) for r in records), data,
+                             case.name)
+
+            offset = expected = 0
+            while offset < len(data):
+                _, offset = case.unpack(data, offset)
+                _, expected = case.klass.unpack(data, expected)
+                self.assertEqual(offset, expected, case.name)
+
+    def testCompare(self):
+        def results(relative):
+            return {'numeric': {'pack': {'relative': relative},
+                                'unpack': {'relative': 1.0}}}
+
+        self.assertEqual(compare(results(0.5), results(0.46)), [])
+        self.assertEqual(compare(results(0.5), results(0.44)),
+                         [('numeric', 'pack', 0.5, 0.44)])
+        self.assertEqual(compare(results(0.5), results(0.44), threshold=0.2), [])
+        self.assertEqual(compare({}, results(0.1)), [])
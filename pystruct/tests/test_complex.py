@@ -2,12 +2,14 @@
 # -*- coding: utf-8
 
 from pystruct.utils import unittest
+import array
 import struct
 
-from pystruct import CStruct
-from pystruct.fields.complex import ArrayField, StructField
-from pystruct.fields.numeric import IntField, UIntField
+from pystruct import CStruct, PackException, UnpackException
+from pystruct.fields.complex import ArrayField, StructField, UnionField
+from pystruct.fields.numeric import IntField, UIntField, ShortField, UByteField
 from pystruct.fields.text import NullStringField
+from pystruct.utils import TypedArray
 
 
 class ArrayFieldTest(unittest.TestCase):
@@ -28,6 +30,17 @@ class ArrayFieldTest(unittest.TestCase):
         self.assertEqual(s.array, self.svalue)
         self.assertEqual(s.pack(), self.sdata)
 
+    def testArrayPackInto(self):
+        class TestStruct(CStruct):
+            count = UIntField(0)
+            array = ArrayField(1, length='count', subfield=IntField(0))
+
+        s = TestStruct(array=self.svalue)
+        buf = bytearray(4 + len(self.sdata) + 2)
+        self.assertEqual(s.pack_into(buf, 2), len(buf))
+        self.assertEqual(bytes(buf[2:]), struct.pack("<I", self.slen) + self.sdata)
+        self.assertEqual(s.pack(), bytes(buf[2:]))
+
     def testArrayUnpack(self):
         class TestStruct(CStruct):
             array = ArrayField(0, length=self.slen, subfield=IntField(0))
@@ -36,6 +49,155 @@ class ArrayFieldTest(unittest.TestCase):
         for i in range(0, self.slen):
             self.assertEqual(s.array[i], self.svalue[i])
 
+    def testTrustedArrayUnpack(self):
+        class TestStruct(CStruct):
+            array = ArrayField(0, length=self.slen, subfield=IntField(0))
+
+        s, offset = TestStruct.unpack(self.sdata)
+        # items are still validated when set later on
+        with self.assertRaisesRegexp(ValueError, "'x' is not a valid value"):
+            s.array[0] = 'x'
+
+    def testLargeArray(self):
+        class TestStruct(CStruct):
+            count = UIntField(0)
+            samples = ArrayField(1, length='count', subfield=ShortField(0))
+
+        values = [(i * 37) % 60000 - 30000 for i in range(4096)]
+        data = struct.pack("<I4096h", 4096, *values)
+        s = TestStruct(samples=values)
+        self.assertEqual(s.pack(), data)
+
+        s, offset = TestStruct.unpack(data)
+        self.assertEqual(offset, len(data))
+        self.assertEqual(s.count, 4096)
+        self.assertEqual(s.samples, values)
+
+    def testArrayBounds(self):
+        class TestStruct(CStruct):
+            array = ArrayField(0, length=-1, subfield=ShortField(0))
+
+        with self.assertRaisesRegexp(ValueError, "out of bounds"):
+            TestStruct(array=[1, 2, 1 << 20, 3])
+        with self.assertRaisesRegexp(ValueError, "'x' is not a valid value"):
+            TestStruct(array=[1, 2, 'x'])
+
+    def testArrayToTheEnd(self):
+        class TestStruct(CStruct):
+            array = ArrayField(0, length=-1, subfield=IntField(0))
+
+        s, offset = TestStruct.unpack(self.sdata)
+        self.assertEqual(offset, len(self.sdata))
+        self.assertEqual(s.array, self.svalue)
+
+    def testFixedArrayRun(self):
+        class TestStruct(CStruct):
+            head = UIntField(0)
+            array = ArrayField(1, length=self.slen, subfield=IntField(0))
+            tail = UIntField(2)
+
+        self.assertEqual(len(TestStruct._layout), 1)
+        data = struct.pack("<I", 1) + self.sdata + struct.pack("<I", 2)
+        s = TestStruct(head=1, array=self.svalue, tail=2)
+        self.assertEqual(s.pack(), data)
+
+        s, offset = TestStruct.unpack(data)
+        self.assertEqual(offset, len(data))
+        self.assertEqual((s.head, s.array, s.tail), (1, self.svalue, 2))
+
+    def testTypedArray(self):
+        class TestStruct(CStruct):
+            array = ArrayField(0, length=-1, subfield=ShortField(0))
+
+        s = TestStruct(array=self.svalue)
+        self.assertIsInstance(s.array, TypedArray)
+        self.assertEqual(s.array.itemsize, 2)
+
+        s.array[1:3] = [7, 7]
+        s.array.append(-1)
+        self.assertEqual(s.array, [1, 7, 7, 3, 5, 8, -1])
+        with self.assertRaisesRegexp(ValueError, "out of bounds"):
+            s.array[0:2] = [1, 1 << 20]
+        with self.assertRaisesRegexp(ValueError, "'x' is not a valid value"):
+            s.array.extend([1, 'x'])
+        self.assertEqual(s.array, [1, 7, 7, 3, 5, 8, -1])
+
+        u, offset = TestStruct.unpack(s.pack())
+        self.assertIsInstance(u.array, TypedArray)
+        self.assertEqual(u.array, s.array)
+        with self.assertRaisesRegexp(ValueError, "out of bounds"):
+            u.array.append(1 << 20)
+
+    def testTypedArrayBulkValidation(self):
+        class TestStruct(CStruct):
+            array = ArrayField(0, length=-1, subfield=ShortField(0))
+
+        # the lowest short is outside of the declared bounds
+        s = TestStruct(array=[1])
+        with self.assertRaisesRegexp(ValueError, "out of bounds"):
+            s.array.fromlist([2, -2 ** 15])
+        with self.assertRaisesRegexp(ValueError, "out of bounds"):
+            s.array += array.array(s.array.typecode, [2, -2 ** 15])
+        raw = struct.pack(str('=h'), -2 ** 15)
+        with self.assertRaisesRegexp(ValueError, "out of bounds"):
+            s.array.frombytes(raw)
+        with self.assertRaisesRegexp(ValueError, "out of bounds"):
+            s.array.fromstring(raw)
+        self.assertEqual(s.array, [1])
+
+        s.array.fromlist([2])
+        s.array += array.array(s.array.typecode, [3])
+        s.array.frombytes(struct.pack(str('=h'), 4))
+        self.assertEqual(s.array, [1, 2, 3, 4])
+
+    def testTypedArrayFixedLength(self):
+        class Counted(CStruct):
+            count = UIntField(0)
+            values = ArrayField(1, length='count', subfield=IntField(0))
+            tail = IntField(2)
+
+        class Fixed(CStruct):
+            values = ArrayField(0, length=3, subfield=IntField(0))
+
+        for s in (Counted(values=[1, 2, 3], tail=9), Fixed(values=[1, 2, 3])):
+            for resize in (lambda a: a.append(4), lambda a: a.extend([4]),
+                           lambda a: a.insert(0, 4), lambda a: a.fromlist([4]),
+                           lambda a: a.pop(), lambda a: a.remove(1),
+                           lambda a: a.__delitem__(0),
+                           lambda a: a.__setitem__(slice(0, 1), [4, 5])):
+                with self.assertRaises(TypeError):
+                    resize(s.values)
+            s.values[0:2] = [4, 5]
+            self.assertEqual(s.values, [4, 5, 3])
+
+        # the length follows a new array
+        s = Counted(values=[1, 2, 3], tail=9)
+        s.values = list(s.values) + [4]
+        u, _ = Counted.unpack(s.pack())
+        self.assertEqual((u.count, u.values, u.tail), (4, [1, 2, 3, 4], 9))
+
+    def testTypedArrayPackInto(self):
+        class TestStruct(CStruct):
+            head = UByteField(0)
+            array = ArrayField(1, length=-1, subfield=IntField(0))
+
+        s = TestStruct(head=1, array=[1, -2, 3])
+        data = struct.pack("<B3i", 1, 1, -2, 3)
+        self.assertEqual(s.pack(), data)
+        for buf in (bytearray(len(data) + 2), memoryview(bytearray(len(data) + 2))):
+            self.assertEqual(s.pack_into(buf, 2), len(data) + 2)
+            self.assertEqual(bytes(bytearray(buf[2:])), data)
+        with self.assertRaises(PackException):
+            s.pack_into(bytearray(len(data) - 1))
+
+    def testArrayPadding(self):
+        class TestStruct(CStruct):
+            array = ArrayField(0, length=4, subfield=IntField(0))
+
+        s = TestStruct(array=[1, 2])
+        self.assertEqual(s.array, [1, 2, 0, 0])
+        self.assertEqual(s.pack(), struct.pack("<4i", 1, 2, 0, 0))
+
 
 class StructFieldTest(unittest.TestCase):
 
@@ -65,3 +227,93 @@ class StructFieldTest(unittest.TestCase):
         s = self.OuterStruct(inner=self.inner)
         data = s.pack()
         self.assertEqual(data[4:-4], self.inner_data)
+
+    def testPackVariableInner(self):
+        class Inner(CStruct):
+            name = NullStringField(0)
+
+        class Outer(CStruct):
+            head = IntField(0)
+            inner = StructField(1, struct=Inner)
+            tail = IntField(2)
+
+        s = Outer(head=1, inner=Inner(name=b'abc\0'), tail=2)
+        self.assertEqual(s.pack(), struct.pack('<i4si', 1, b'abc\0', 2))
+
+    def testFixedInnerStruct(self):
+        class FixedOuter(CStruct):
+            head = UIntField(0, default=1)
+            inner = StructField(1, struct=self.InnerStruct)
+            post = IntField(2, default=-1)
+
+        self.assertEqual(len(FixedOuter._layout), 1)
+        data = struct.pack('<Iiii', 1, 13, 42, -1)
+        s = FixedOuter(inner=self.inner)
+        self.assertEqual(s.pack(), data)
+
+        s, offset = FixedOuter.unpack(data)
+        self.assertEqual(offset, len(data))
+        self.assertIsInstance(s.inner, self.InnerStruct)
+        self.assertEqual((s.inner.one, s.inner.two), (13, 42))
+        self.assertEqual(s.post, -1)
+
+    def testUnpack(self):
+        data = self.OuterStruct(inner=self.inner).pack()
+        s, offset = self.OuterStruct.unpack(bytearray(data))
+        self.assertEqual(offset, len(data))
+        self.assertEqual(s.pad, b'KOT\0')
+        self.assertEqual((s.inner.one, s.inner.two), (13, 42))
+        self.assertEqual(s.post, 0xbebafeca)
+
+    def testValidateNested(self):
+        class FixedOuter(CStruct):
+            inner = StructField(0, struct=self.InnerStruct)
+
+        data = struct.pack('<ii', -2 ** 31, 0)
+        s, offset = FixedOuter.unpack(data)
+        self.assertEqual(s.inner.one, -2 ** 31)
+        with self.assertRaisesRegexp(ValueError, "out of bounds"):
+            FixedOuter.unpack(data, validate=True)
+
+        data = b'KOT\0' + data + struct.pack('<I', 0)
+        s, offset = self.OuterStruct.unpack(data)
+        self.assertEqual(s.inner.one, -2 ** 31)
+        with self.assertRaisesRegexp(ValueError, "out of bounds"):
+            self.OuterStruct.unpack(data, validate=True)
+
+
+class UnionFieldTest(unittest.TestCase):
+
+    def setUp(self):
+        class Point(CStruct):
+            kind = UByteField(0, prefix=b'\x01', default=1)
+            x = IntField(1)
+            y = IntField(2)
+
+        class Label(CStruct):
+            kind = UByteField(0, prefix=b'\x02', default=2)
+            text = NullStringField(1)
+
+        class Shape(CStruct):
+            part = UnionField(0, structs=[Point, Label])
+            tail = UIntField(1, default=0xcafebabe)
+
+        self.Point, self.Label, self.Shape = Point, Label, Shape
+
+    def testPackUnpack(self):
+        for part in (self.Point(x=1, y=-1), self.Label(text=b'abc\0')):
+            s = self.Shape(part=part)
+            data = s.pack()
+            self.assertEqual(data, part.pack() + struct.pack("<I", 0xcafebabe))
+
+            u, offset = self.Shape.unpack(data)
+            self.assertEqual(offset, len(data))
+            self.assertIs(type(u.part), type(part))
+            self.assertEqual(u.pack(), data)
+            self.assertEqual(self.Shape.unpack_lazy(data).tail, 0xcafebabe)
+
+    def testInvalid(self):
+        with self.assertRaisesRegexp(ValueError, "is not a valid value"):
+            self.Shape(part=self.Shape())
+        with self.assertRaises(UnpackException):
+            self.Shape.unpack(b'\x03' + b'\x00' * 12)
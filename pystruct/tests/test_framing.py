@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from pystruct.utils import unittest
+import io
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from pystruct import IncompleteDataException, UnpackException
+from pystruct.framing import FrameWriter, FrameReader, FrameHeader
+from pystruct.tests.test_struct import Header, Message
+from pystruct.fields.text import CStructVarString
+
+
+class FramingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = [
+            Message(header=Header(kind=i), name=b'n' * i + b'\0',
+                    values=list(range(i)),
+                    comment=CStructVarString(text=b'c' * (3 * i)))
+            for i in range(50)]
+        self.size = sum(len(m.pack()) for m in self.messages)
+
+    def write(self, **options):
+        stream = io.BytesIO()
+        with FrameWriter(stream, Message, **options) as writer:
+            writer.write_many(self.messages)
+        return stream.getvalue()
+
+    def frames(self, data):
+        stream = io.BytesIO(data)
+        headers = []
+        while stream.tell() < len(data):
+            header = FrameHeader.read_from(stream)
+            stream.seek(header.size, io.SEEK_CUR)
+            headers.append(header)
+        return headers
+
+    def assertRoundTrip(self, data):
+        messages = list(FrameReader(io.BytesIO(data), Message))
+        self.assertEqual([m.pack() for m in messages],
+                         [m.pack() for m in self.messages])
+
+    def testUncompressed(self):
+        data = self.write()
+        self.assertRoundTrip(data)
+        headers = self.frames(data)
+        self.assertEqual([(h.count, h.size) for h in headers], [(50, self.size)])
+
+    def testBlockSize(self):
+        data = self.write(block_size=1024)
+        self.assertRoundTrip(data)
+        headers = self.frames(data)
+        self.assertTrue(len(headers) > 1)
+        self.assertEqual(sum(h.count for h in headers), 50)
+        self.assertTrue(all(h.size < 1024 + 400 for h in headers))
+
+    def testZlib(self):
+        data = self.write(compression='zlib', level=9)
+        self.assertRoundTrip(data)
+        self.assertTrue(len(data) < self.size // 2)
+
+    @unittest.skipIf(lzma is None, "lzma is not available")
+    def testLzma(self):
+        data = self.write(compression='lzma')
+        self.assertRoundTrip(data)
+        self.assertTrue(len(data) < self.size // 2)
+
+    def testTruncated(self):
+        data = self.write(compression='zlib', block_size=1024)
+        with self.assertRaises(IncompleteDataException):
+            list(FrameReader(io.BytesIO(data[:-1]), Message))
+        with self.assertRaises(IncompleteDataException):
+            list(FrameReader(io.BytesIO(data[:5]), Message))
+        self.assertEqual(list(FrameReader(io.BytesIO(b''), Message)), [])
+
+    def testUnknownCompression(self):
+        with self.assertRaisesRegexp(ValueError, "Unknown compression"):
+            FrameWriter(io.BytesIO(), Message, compression='zip')
+
+    def frame(self, block, count, raw_size, compression=1):
+        header = FrameHeader(size=len(block), count=count, raw_size=raw_size,
+                             compression=compression)
+        return header.pack() + block
+
+    def testDecompressionLimit(self):
+        # a small block on the wire, which claims to be small when
+        # decompressed too - but isn't
+        data = self.frame(zlib.compress(b'\0' * 10 ** 7), 1, 100)
+        with self.assertRaisesRegexp(UnpackException, "decompress to 100 bytes"):
+            list(FrameReader(io.BytesIO(data), Message))
+
+        data = self.frame(zlib.compress(b'\0' * 100), 1, 10 ** 9)
+        with self.assertRaisesRegexp(UnpackException, "too big"):
+            list(FrameReader(io.BytesIO(data), Message))
+
+    def testRecordsFillBlock(self):
+        records = b''.join(m.pack() for m in self.messages[:3])
+        for count in (2, 4):
+            data = self.frame(zlib.compress(records), count, len(records))
+            with self.assertRaisesRegexp(UnpackException, "doesn't hold"):
+                list(FrameReader(io.BytesIO(data), Message))
+
+        headers = b''.join(Header(kind=i).pack() for i in range(3))
+        data = self.frame(headers + b'\0', 3, len(headers) + 1, compression=0)
+        with self.assertRaisesRegexp(UnpackException, "doesn't hold"):
+            list(FrameReader(io.BytesIO(data), Header))
+        data = self.frame(headers, 3, len(headers), compression=0)
+        self.assertEqual([h.kind for h in FrameReader(io.BytesIO(data), Header)],
+                         [0, 1, 2])
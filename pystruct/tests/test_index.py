@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from pystruct.utils import unittest
+import os
+import shutil
+import tempfile
+
+from pystruct.index import RecordIndex
+from pystruct.tests.test_struct import Header, Message
+from pystruct.fields.text import CStructVarString
+
+
+class CountingMessage(Message):
+    skipped = 0
+
+    @classmethod
+    def _skip(cls, data, offset=0):
+        CountingMessage.skipped += 1
+        return Message._skip(data, offset)
+
+
+class RecordIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'records.bin')
+        self.messages = [
+            Message(header=Header(kind=i), name=b'n' * i + b'\0',
+                    values=list(range(i)),
+                    comment=CStructVarString(text=b'c' * (3 * i)))
+            for i in range(20)]
+        self.write(self.messages)
+        CountingMessage.skipped = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, records, mode='wb'):
+        with open(self.path, mode) as f:
+            for record in records:
+                f.write(record.pack())
+
+    def testGet(self):
+        with RecordIndex(CountingMessage, self.path) as index:
+            self.assertEqual(len(index), 20)
+            for n in (19, 0, 7):
+                self.assertEqual(index.get(n).pack(), self.messages[n].pack())
+        self.assertEqual(CountingMessage.skipped, 20)
+        self.assertTrue(os.path.exists(self.path + '.idx'))
+
+        # the saved index is used next time
+        with RecordIndex(CountingMessage, self.path) as index:
+            self.assertEqual(len(index), 20)
+            self.assertEqual(index.get(19).pack(), self.messages[19].pack())
+        self.assertEqual(CountingMessage.skipped, 20)
+
+    def testAppend(self):
+        RecordIndex(Message, self.path).close()
+        self.write(self.messages[:2], 'ab')
+        # a record, which isn't complete yet
+        with open(self.path, 'ab') as f:
+            f.write(self.messages[5].pack()[:-1])
+
+        with RecordIndex(CountingMessage, self.path) as index:
+            self.assertEqual(len(index), 22)
+            self.assertEqual(CountingMessage.skipped, 3)
+            self.assertEqual(index.get(21).pack(), self.messages[1].pack())
+
+        with RecordIndex(Message, self.path) as index:
+            self.assertEqual(len(index), 22)
+
+    def testReplacedFile(self):
+        RecordIndex(Message, self.path).close()
+        self.write(self.messages[3:5])
+        with RecordIndex(Message, self.path) as index:
+            self.assertEqual(len(index), 2)
+            self.assertEqual(index.get(1).pack(), self.messages[4].pack())
+
+    def testRewrittenFile(self):
+        RecordIndex(Message, self.path).close()
+        # the same size, but the records are in a different order
+        self.write(reversed(self.messages))
+        with RecordIndex(Message, self.path) as index:
+            self.assertEqual(len(index), 20)
+            self.assertEqual(index.get(1).pack(), self.messages[18].pack())
+
+            # rewritten in place, while the index is open
+            with open(self.path, 'r+b') as f:
+                for record in self.messages[10:]:
+                    f.write(record.pack())
+            index.update()
+            self.assertEqual(index.get(1).pack(), self.messages[11].pack())
+
+    def testFixedSize(self):
+        self.write([Header(kind=i) for i in range(10)])
+        with RecordIndex(Header, self.path) as index:
+            self.assertEqual(list(index.offsets), list(range(0, 40, 4)))
+            self.assertEqual(index.get(9).kind, 9)
+            self.assertEqual(index.get(-1).kind, 9)
+        # the offsets are computed, there's nothing to save
+        self.assertFalse(os.path.exists(self.path + '.idx'))
+
+    def testEmptyFile(self):
+        self.write([])
+        with RecordIndex(Message, self.path) as index:
+            self.assertEqual(len(index), 0)
@@ -4,12 +4,14 @@
 import struct
 from pystruct.utils import unittest
 
-from pystruct import CStruct, UnpackException
+from pystruct import CStruct, UnpackException, IncompleteDataException
 from pystruct.constraints import PrefixConstraint
+from pystruct.fields.complex import ArrayField
 from pystruct.fields.numeric import (NumericField,
                     ByteField, UByteField,
                     ShortField, UShortField,
-                    IntField, UIntField)
+                    IntField, UIntField,
+                    VarUIntField, VarIntField)
 from pystruct.common import PackException
 
 
@@ -38,6 +40,13 @@ class NumericFieldTest(unittest.TestCase):
         v, offset = TestStruct.unpack(self.idata)
         self.assertEqual(v.intField, self.ivalue)
 
+    def testPrefixMatchBuffers(self):
+        class TestStruct(CStruct):
+            intField = NumericField(0, ctype='int', prefix=self.idata[0:2])
+        for data in (bytearray(self.idata), memoryview(self.idata)):
+            v, offset = TestStruct.unpack(data)
+            self.assertEqual(v.intField, self.ivalue)
+
     def testPrefixMismatch(self):
         class TestStruct(CStruct):
             intField = NumericField(0, ctype='int', prefix=b'abc')
@@ -132,3 +141,163 @@ class NumericFieldTest(unittest.TestCase):
             B(f=5645442)
         with self.assertRaisesRegexp(ValueError, "out of bounds"):
             C(f=(-1))
+
+    def testFixedRun(self):
+        values = list(range(-10, 10))
+        TestStruct = type(CStruct)(str('TestStruct'), (CStruct,),
+            dict(('f%d' % i, IntField(i)) for i in range(len(values))))
+
+        self.assertEqual(len(TestStruct._layout), 1)
+        data = struct.pack('<20i', *values)
+        v, offset = TestStruct.unpack(data)
+        self.assertEqual(offset, len(data))
+        self.assertEqual([getattr(v, 'f%d' % i) for i in range(20)], values)
+        self.assertEqual(v.pack(), data)
+
+    def testFixedRunBrokenByPrefix(self):
+        class TestStruct(CStruct):
+            f1 = IntField(0)
+            f2 = UIntField(1, prefix=b'\xbe')
+            f3 = ShortField(2)
+            f4 = ByteField(3)
+
+        self.assertEqual(len(TestStruct._layout), 3)
+        self.assertEqual(TestStruct._fixed_run, None)
+
+        data = struct.pack('<iIhb', 7, 0xcafebabe, -2, 3)
+        v, offset = TestStruct.unpack(data)
+        self.assertEqual(offset, len(data))
+        self.assertEqual((v.f1, v.f2, v.f3, v.f4), (7, 0xcafebabe, -2, 3))
+        self.assertEqual(v.pack(), data)
+
+    def testPackInto(self):
+        class TestStruct(CStruct):
+            f1 = IntField(0)
+            f2 = ShortField(1, prefix=b'\x02')
+
+        buf = bytearray(18)
+        offset = 0
+        for i in range(2, 4):
+            offset = TestStruct(f1=i, f2=2).pack_into(buf, offset)
+        self.assertEqual(offset, 12)
+        self.assertEqual(bytes(buf[:offset]), struct.pack('<ihih', 2, 2, 3, 2))
+
+        view = memoryview(buf)
+        self.assertEqual(TestStruct(f1=-1, f2=2).pack_into(view, 12), 18)
+        self.assertEqual(bytes(buf[12:]), struct.pack('<ih', -1, 2))
+
+    def testPackIntoWithOffset(self):
+        class TestStruct(CStruct):
+            offset_field = UIntField(0)
+            data = IntField(1, offset='offset_field')
+
+        buf = bytearray(16)
+        self.assertEqual(TestStruct(data=7).pack_into(buf, 8), 16)
+        self.assertEqual(bytes(buf[8:]), struct.pack('<Ii', 12, 7))
+
+    def testTrustedUnpack(self):
+        class TestStruct(CStruct):
+            f1 = IntField(0)
+            f2 = ShortField(1, prefix=b'\x00')
+
+        # the lowest int is outside of the declared bounds
+        data = struct.pack('<ih', -2 ** 31, 0)
+        v, offset = TestStruct.unpack(data)
+        self.assertEqual((v.f1, v.f2), (-2 ** 31, 0))
+
+        with self.assertRaisesRegexp(ValueError, "out of bounds"):
+            TestStruct.unpack(data, validate=True)
+        v, offset = TestStruct.unpack(struct.pack('<ih', 5, 0), validate=True)
+        self.assertEqual((v.f1, v.f2), (5, 0))
+
+
+class VarIntFieldTest(unittest.TestCase):
+
+    def testVarUInt(self):
+        class TestStruct(CStruct):
+            value = VarUIntField(0)
+            tail = UByteField(1, default=0xff)
+
+        for (value, data) in ((0, b'\x00'), (127, b'\x7f'), (128, b'\x80\x01'),
+                              (300, b'\xac\x02'), (2 ** 64 - 1, b'\xff' * 9 + b'\x01')):
+            s = TestStruct(value=value)
+            self.assertEqual(s.pack(), data + b'\xff')
+            s, offset = TestStruct.unpack(memoryview(data + b'\xff'))
+            self.assertEqual((s.value, offset), (value, len(data) + 1))
+
+        with self.assertRaisesRegexp(ValueError, "out of bounds"):
+            TestStruct(value=-1)
+        with self.assertRaises(IncompleteDataException):
+            TestStruct.unpack(b'\x80\x80')
+        with self.assertRaises(UnpackException):
+            TestStruct.unpack(b'\x80' * 20)
+        with self.assertRaises(UnpackException):
+            TestStruct.unpack(b'\x80' * 10 + b'\x00\xff')
+        # 2 ** 64
+        with self.assertRaises(UnpackException):
+            TestStruct.unpack(b'\x80' * 9 + b'\x02\xff')
+
+    def testEncodedOnce(self):
+        class CountingField(VarUIntField):
+            encoded = 0
+
+            def _packable(self, value):
+                CountingField.encoded += 1
+                return VarUIntField._packable(self, value)
+
+        class TestStruct(CStruct):
+            value = CountingField(0)
+            tail = UByteField(1, default=0xff)
+
+        self.assertEqual(TestStruct(value=300).pack(), b'\xac\x02\xff')
+        self.assertEqual(CountingField.encoded, 1)
+
+    def testVarIntZigzag(self):
+        class TestStruct(CStruct):
+            value = VarIntField(0)
+
+        for (value, data) in ((0, b'\x00'), (-1, b'\x01'), (1, b'\x02'),
+                              (-64, b'\x7f'), (64, b'\x80\x01'),
+                              (-2 ** 63, b'\xff' * 9 + b'\x01')):
+            self.assertEqual(TestStruct(value=value).pack(), data)
+            self.assertEqual(TestStruct.unpack(data)[0].value, value)
+
+    def testLengthSource(self):
+        class TestStruct(CStruct):
+            count = VarUIntField(0)
+            values = ArrayField(1, length='count', subfield=IntField(0))
+
+        s = TestStruct(values=list(range(200)))
+        self.assertEqual(s.count, 200)
+        data = s.pack()
+        self.assertEqual(data[:2], b'\xc8\x01')
+        self.assertEqual(len(data), 2 + 4 * 200)
+
+        s, offset = TestStruct.unpack(data)
+        self.assertEqual((s.count, offset), (200, len(data)))
+        self.assertEqual(s.values, list(range(200)))
+
+    def testArray(self):
+        class TestStruct(CStruct):
+            count = VarUIntField(0)
+            values = ArrayField(1, length='count', subfield=VarIntField(0))
+
+        class Rest(CStruct):
+            values = ArrayField(0, length=-1, subfield=VarIntField(0))
+
+        values = [(-1) ** i * i ** 3 for i in range(300)]
+        s = TestStruct(values=values)
+        data = s.pack()
+        self.assertEqual(s.packed_size(), len(data))
+
+        s, offset = TestStruct.unpack(data)
+        self.assertEqual((s.values, offset), (values, len(data)))
+        s, offset = Rest.unpack(data, 2)
+        self.assertEqual((s.values, offset), (values, len(data)))
+
+        with self.assertRaises(IncompleteDataException):
+            TestStruct.unpack(data[:-1])
+        with self.assertRaises(IncompleteDataException):
+            Rest.unpack(data[:-1], 2)
+        with self.assertRaisesRegexp(ValueError, "out of bounds"):
+            TestStruct(values=[2 ** 63])
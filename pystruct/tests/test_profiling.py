@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from pystruct.utils import unittest
+import sys
+
+from pystruct.profiling import Profiler, profile
+from pystruct.tests.test_struct import Header, Message
+from pystruct.fields.text import CStructVarString
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.message = Message(header=Header(kind=3, flags=1),
+                               name=b'test\0', values=[1, 2, 3],
+                               comment=CStructVarString(text=b'Hello'))
+        self.data = self.message.pack()
+
+    def testUnpack(self):
+        with profile() as profiler:
+            for _ in range(5):
+                Message.unpack(self.data)
+
+        stats = profiler.stats
+        self.assertEqual(stats['struct', 'Message', 'unpack'][0], 5)
+        self.assertEqual(stats['struct', 'Message', 'unpack'][2],
+                         5 * len(self.data))
+        self.assertEqual(stats['field', 'Message.values', 'unpack'][0::2],
+                         [5, 5 * 12])
+        self.assertEqual(stats['run', 'Message.header', 'unpack_into'][0::2],
+                         [5, 5 * 4])
+        # both the array and the string have a length
+        self.assertEqual(stats['constraint', 'LengthConstraint',
+                               'before_unpack'][0], 10)
+
+    def testPack(self):
+        with profile() as profiler:
+            self.message.pack()
+        stats = profiler.stats
+        self.assertEqual(stats['struct', 'Message', 'pack'][0::2],
+                         [1, len(self.data)])
+        self.assertEqual(stats['field', 'Message.name', 'pack_into'][0::2],
+                         [1, 5])
+
+    def testDisabled(self):
+        profiler = Profiler()
+        with profile(profiler):
+            Message.unpack(self.data)
+        self.assertEqual(sys.getprofile(), None)
+
+        calls = profiler.stats['struct', 'Message', 'unpack'][0]
+        Message.unpack(self.data)
+        self.assertEqual(profiler.stats['struct', 'Message', 'unpack'][0], calls)
+
+        with profile(profiler):
+            Message.unpack(self.data)
+        self.assertEqual(profiler.stats['struct', 'Message', 'unpack'][0],
+                         calls + 1)
+
+    def testTable(self):
+        with profile() as profiler:
+            Message.unpack(self.data)
+        table = profiler.table().splitlines()
+        self.assertEqual(table[0].split()[:3], ['kind', 'name', 'operation'])
+        self.assertEqual(len(table), len(profiler.rows()) + 1)
+
+    def testRestorePrevious(self):
+        def previous(frame, event, arg):
+            pass
+
+        sys.setprofile(previous)
+        try:
+            with profile():
+                Message.unpack(self.data)
+            self.assertIs(sys.getprofile(), previous)
+        finally:
+            sys.setprofile(None)
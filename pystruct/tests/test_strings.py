@@ -3,10 +3,15 @@
 from __future__ import unicode_literals
 
 from pystruct.utils import unittest
+import mmap
 import struct
+import tempfile
 
-from pystruct import CStruct
-from pystruct.fields.text import StringField, NullStringField
+from pystruct import CStruct, IncompleteDataException
+from pystruct.fields.complex import ArrayField
+from pystruct.fields.text import (StringField, NullStringField,
+                                  VarcharField, CStructVarString,
+                                  CompactVarcharField, CStructCompactString)
 from pystruct.fields.numeric import IntField
 
 
@@ -65,6 +70,19 @@ class StringFieldTest(unittest.TestCase):
         self.assertEqual(s.text, self.svalue)
         self.assertEqual(s.tlen, self.slen)
 
+    def testFixedStringRun(self):
+        class TestStruct(CStruct):
+            tag = IntField(0)
+            text = StringField(1, length=self.slen)
+            checksum = IntField(2)
+
+        self.assertEqual(len(TestStruct._layout), 1)
+        data = struct.pack(b"<i", 5) + self.sdata + struct.pack(b"<i", 7)
+        s, offset = TestStruct.unpack(data)
+        self.assertEqual(offset, len(data))
+        self.assertEqual((s.tag, s.text, s.checksum), (5, self.svalue, 7))
+        self.assertEqual(s.pack(), data)
+
     def test0PackNullString(self):
         class TestStruct(CStruct):
             text = NullStringField(0)
@@ -72,3 +90,115 @@ class StringFieldTest(unittest.TestCase):
 
         s = TestStruct(text=b'Ala ma kota\0')
         self.assertEqual(s.pack(), b'Ala ma kota\0' + struct.pack(b"<i", 0x7afebabe))
+
+    def testUnpackFromBuffers(self):
+        class TestStruct(CStruct):
+            tlen = IntField(0)
+            text = StringField(1, length='tlen')
+            name = NullStringField(2)
+            checksum = IntField(3)
+
+        data = self.sdata_ext + b'Ala ma kota\0' + struct.pack(b"<i", 0x7afebabe)
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            for buf in (bytearray(data), memoryview(data), mapped):
+                s, offset = TestStruct.unpack(buf)
+                self.assertEqual(offset, len(data))
+                self.assertEqual(s.text, self.svalue)
+                self.assertEqual(s.name, b'Ala ma kota\0')
+                self.assertEqual(s.checksum, 0x7afebabe)
+            mapped.close()
+
+    def testUnpackViews(self):
+        class TestStruct(CStruct):
+            text = StringField(0, length=self.slen, view=True)
+            name = NullStringField(1, view=True)
+
+        data = bytearray(self.sdata + b'Ala ma kota\0')
+        s, offset = TestStruct.unpack(data)
+        self.assertEqual(offset, len(data))
+        self.assertIsInstance(s.text, memoryview)
+        self.assertEqual(s.text, self.svalue)
+        self.assertEqual(s.name, b'Ala ma kota\0')
+
+        # the values share memory with the source
+        data[0:5] = b'HELLO'
+        self.assertEqual(s.text.tobytes(), b'HELLO World!')
+        self.assertEqual(s.pack(), bytes(data))
+
+    def testBoundedNullString(self):
+        scanned = []
+
+        class TrackingBytes(bytes):
+            def find(self, sub, start, end):
+                scanned.append(end - start)
+                return bytes.find(self, sub, start, end)
+
+        class TestStruct(CStruct):
+            name = NullStringField(0, max_length=4)
+
+        data = TrackingBytes(b'ab\0' + b'x' * 1000)
+        s, offset = TestStruct.unpack(data)
+        self.assertEqual((s.name, offset), (b'ab\0', 3))
+
+        # the terminator isn't looked for past the maximum length
+        s, offset = TestStruct.unpack(data, 3)
+        self.assertEqual(offset, 7)
+        self.assertTrue(max(scanned) <= 4)
+
+        with self.assertRaises(IncompleteDataException):
+            TestStruct.unpack(b'abc')
+
+    def testNullStringArray(self):
+        class TestStruct(CStruct):
+            count = IntField(0)
+            names = ArrayField(1, length='count', subfield=NullStringField(0))
+
+        class Rest(CStruct):
+            names = ArrayField(0, length=-1, subfield=NullStringField(0))
+
+        # long enough to be scanned in several pieces
+        names = [('name %d' % i).encode('ascii') + b'\0' for i in range(1000)]
+        data = TestStruct(names=names).pack()
+        for buf in (data, bytearray(data), memoryview(data)):
+            s, offset = TestStruct.unpack(buf)
+            self.assertEqual(offset, len(data))
+            self.assertEqual(s.names, names)
+
+            s, offset = Rest.unpack(buf, 4)
+            self.assertEqual(offset, len(data))
+            self.assertEqual(s.names, names)
+
+        with self.assertRaises(IncompleteDataException):
+            TestStruct.unpack(data[:-1])
+        with self.assertRaises(IncompleteDataException):
+            Rest.unpack(data[:-1], 4)
+
+    def testVarchar(self):
+        class TestStruct(CStruct):
+            text = VarcharField(0)
+            checksum = IntField(1, default=0x7afebabe)
+
+        s = TestStruct(text=CStructVarString(text=self.svalue))
+        data = s.pack()
+        self.assertEqual(data, self.sdata_ext + struct.pack(b"<i", 0x7afebabe))
+
+        s, offset = TestStruct.unpack(data)
+        self.assertEqual(offset, len(data))
+        self.assertEqual(s.text.text, self.svalue)
+
+    def testCompactVarchar(self):
+        class TestStruct(CStruct):
+            text = CompactVarcharField(0)
+            checksum = IntField(1, default=0x7afebabe)
+
+        s = TestStruct(text=CStructCompactString(text=self.svalue))
+        data = s.pack()
+        self.assertEqual(data, b'\x0c' + self.sdata + struct.pack(b"<i", 0x7afebabe))
+
+        s, offset = TestStruct.unpack(data)
+        self.assertEqual(offset, len(data))
+        self.assertEqual(s.text.text, self.svalue)
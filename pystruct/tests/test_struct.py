@@ -0,0 +1,851 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+from pystruct.utils import unittest
+import io
+import socket
+import struct
+import sys
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pystruct import (CStruct, FrozenCStruct, UnpackException,
+                      PackException, IncompleteDataException)
+from pystruct.fields.complex import ArrayField, StructField
+from pystruct.fields.numeric import IntField, UIntField, UShortField
+from pystruct.fields.text import (StringField, NullStringField,
+                                  VarcharField, CStructVarString)
+from pystruct.profiling import profile
+
+
+class Header(CStruct):
+    kind = UShortField(0)
+    flags = UShortField(1)
+
+
+class Message(CStruct):
+    header = StructField(0, struct=Header)
+    name = NullStringField(1)
+    count = UIntField(2)
+    values = ArrayField(3, length='count', subfield=IntField(0))
+    comment = VarcharField(4)
+    checksum = UIntField(5)
+
+
+class LazyUnpackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.message = Message(header=Header(kind=3, flags=1),
+                               name=b'test\0', values=[1, 2, 3],
+                               comment=CStructVarString(text=b'Hello'),
+                               checksum=0xcafebabe)
+        self.data = self.message.pack()
+
+    def testDecodeOnAccess(self):
+        s = Message.unpack_lazy(self.data)
+        self.assertEqual(len(s._lazy_values), 0)
+
+        self.assertEqual(s.checksum, 0xcafebabe)
+        # only the length of the array had to be decoded on the way
+        self.assertEqual(sorted(s._lazy_values.keys()), ['checksum', 'count'])
+
+        self.assertEqual(s.header.kind, 3)
+        self.assertEqual(s.name, b'test\0')
+        self.assertEqual(s.values, [1, 2, 3])
+        self.assertEqual(s.comment.text, b'Hello')
+
+    def testPackLazy(self):
+        s = Message.unpack_lazy(bytearray(self.data))
+        self.assertEqual(s.pack(), self.data)
+
+    def testOffsetInBuffer(self):
+        s = Message.unpack_lazy(b'garbage' + self.data, 7)
+        self.assertEqual(s.count, 3)
+        self.assertEqual(s.checksum, 0xcafebabe)
+
+    def testSetBeforeDecode(self):
+        s = Message.unpack_lazy(self.data)
+        s.name = b'other name\0'
+        self.assertEqual(s.name, b'other name\0')
+        self.assertEqual(s.checksum, 0xcafebabe)
+
+    def testBrokenTail(self):
+        class TestStruct(CStruct):
+            head = IntField(0)
+            tail = NullStringField(1)
+
+        s = TestStruct.unpack_lazy(struct.pack("<i", 5) + b'no terminator')
+        self.assertEqual(s.head, 5)
+        with self.assertRaises(UnpackException):
+            s.tail
+
+    def testSkip(self):
+        self.assertEqual(Message._skip(b'xx' + self.data + b'yy', 2),
+                         2 + len(self.data))
+
+
+class ProjectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.message = Message(header=Header(kind=3, flags=1),
+                               name=b'test\0', values=list(range(100)),
+                               comment=CStructVarString(text=b'Hello'),
+                               checksum=0xcafebabe)
+        self.data = b'xx' + self.message.pack() + b'yy'
+
+    def testSelectedFields(self):
+        s, offset = Message.unpack(self.data, 2, fields=('checksum', 'name'))
+        self.assertEqual(offset, len(self.data) - 2)
+        self.assertEqual((s.checksum, s.name), (0xcafebabe, b'test\0'))
+        with self.assertRaises(AttributeError):
+            s.values
+
+        s, offset = Message.unpack(self.data, 2, validate=True,
+                                   fields=['header'])
+        self.assertEqual(s.header.kind, 3)
+
+    def testSkipping(self):
+        with profile() as profiler:
+            Message.unpack(self.data, 2, fields=('checksum',))
+        operations = set((name, op) for (kind, name, op) in profiler.stats)
+        self.assertIn(('Message.values', 'skip'), operations)
+        self.assertNotIn(('Message.values', 'unpack'), operations)
+        self.assertNotIn(('Message.comment', 'unpack'), operations)
+
+    def testErrors(self):
+        with self.assertRaisesRegexp(ValueError, "Unknown fields"):
+            Message.unpack(self.data, 2, fields=('checksum', 'other'))
+        with self.assertRaises(IncompleteDataException):
+            Message.unpack(self.data[:-3], 2, fields=('name',))
+
+
+class PackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.message = Message(header=Header(kind=3, flags=1),
+                               name=b'test\0', values=[1, 2, 3],
+                               comment=CStructVarString(text=b'Hello'),
+                               checksum=0xcafebabe)
+
+    def testPackedSize(self):
+        self.assertEqual(Header().packed_size(), 4)
+        self.assertEqual(self.message.packed_size(), len(self.message.pack()))
+        self.message.values = list(range(10))
+        self.assertEqual(self.message.packed_size(), len(self.message.pack()))
+
+    def testSinglePass(self):
+        sizes = []
+
+        class CountingField(UIntField):
+            def before_pack(self, obj, offset, **opts):
+                sizes.append(offset)
+                return UIntField.before_pack(self, obj, offset, **opts)
+
+        class TestStruct(CStruct):
+            name = NullStringField(0)
+            value = CountingField(1)
+            inner = StructField(2, struct=Message)
+
+        s = TestStruct(name=b'x\0', value=1, inner=self.message)
+        self.assertFalse(TestStruct._pack_fixups)
+        data = s.pack()
+        self.assertEqual(sizes, [])
+        self.assertEqual(data, b'x\0' + struct.pack("<I", 1) + self.message.pack())
+
+    def testOffsetField(self):
+        class TestStruct(CStruct):
+            pointer = UIntField(0)
+            name = NullStringField(1)
+            value = UIntField(2, offset='pointer')
+
+        self.assertTrue(TestStruct._pack_fixups)
+        s = TestStruct(name=b'abc\0', value=7)
+        self.assertEqual(s.pack(), struct.pack("<I4sI", 8, b'abc\0', 7))
+        self.assertEqual(s.pack(100), struct.pack("<I4sI", 108, b'abc\0', 7))
+
+    def testBufferTooSmall(self):
+        class Point(FrozenCStruct):
+            x = IntField(0)
+
+        class Numbers(CStruct):
+            values = ArrayField(0, length=-1, subfield=IntField(0))
+
+        # scalar fields, fixed runs, arrays of numbers, frozen structures
+        for s in (self.message, Header(), Numbers(values=[1, 2]), Point()):
+            size = len(s.pack())
+            for buf in (bytearray(size - 1), memoryview(bytearray(size + 1))):
+                with self.assertRaises(PackException):
+                    s.pack_into(buf, len(buf) - size + 1)
+            # a `bytearray` isn't resized
+            buf = bytearray(size - 1)
+            with self.assertRaises(PackException):
+                s.pack_into(buf)
+            self.assertEqual(len(buf), size - 1)
+
+    def testPackAtOffset(self):
+        class TestStruct(CStruct):
+            name = NullStringField(0)
+            value = IntField(1, offset=2 ** 40 + 4)
+
+        s = TestStruct(name=b'abc\0', value=7)
+        # nothing is allocated for the space before the structure
+        self.assertEqual(s.pack(2 ** 40), struct.pack("<4si", b'abc\0', 7))
+        with self.assertRaises(PackException):
+            s.pack()
+
+
+class PatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.message = Message(header=Header(kind=3, flags=1),
+                               name=b'test\0', values=[1, 2, 3],
+                               comment=CStructVarString(text=b'Hello'),
+                               checksum=0xcafebabe)
+        self.data = b'xx' + self.message.pack()
+
+    def changed_bytes(self, before, after):
+        before, after = bytearray(before), bytearray(after)
+        return [i for i in range(len(before)) if before[i] != after[i]]
+
+    def testFixedOffsets(self):
+        buf = bytearray(self.data)
+        s, end = Message.unpack(buf, 2, track_changes=True)
+        self.assertEqual(s.patch_into(buf, 2), end)  # nothing changed
+        self.assertEqual(buf, bytearray(self.data))
+
+        s.checksum = 0xcafebabf
+        s.header.flags = 2
+        self.assertEqual(s.patch_into(buf, 2), end)
+        self.assertEqual(bytes(buf[2:]), s.pack())
+        # the lowest bytes of both numbers
+        self.assertEqual(self.changed_bytes(self.data, buf), [4, len(buf) - 4])
+
+        # the changes were written
+        s.comment = CStructVarString(text=b'HELLO')
+        s.patch_into(buf, 2)
+        self.assertEqual(len(self.changed_bytes(self.data, buf)), 2 + 4)
+
+    def testSameSize(self):
+        buf = memoryview(bytearray(self.data))
+        s, end = Message.unpack(buf, 2, track_changes=True)
+        s.name = b'TEST\0'
+        s.values = [3, 2, 1]
+        self.assertEqual(s.patch_into(buf, 2), end)
+        self.assertEqual(buf[2:].tobytes(), s.pack())
+
+        s.values = [1, 2]
+        with self.assertRaisesRegexp(ValueError, "can't be resized"):
+            s.patch_into(buf, 2)
+
+    def testResize(self):
+        buf = bytearray(self.data + b'yy')
+        s, end = Message.unpack(buf, 2, track_changes=True)
+        s.values = [1, 2, 3, 4, 5]
+        self.assertEqual(s.patch_into(buf, 2), end + 8)
+        self.assertEqual(bytes(buf), b'xx' + s.pack() + b'yy')
+
+    def testFixedLayout(self):
+        buf = bytearray(Header(kind=1, flags=2).pack())
+        s = Header.unpack_lazy(buf, track_changes=True)
+        s.flags = 7
+        self.assertEqual(s.patch_into(buf), 4)
+        self.assertEqual(bytes(buf), Header(kind=1, flags=7).pack())
+
+    def testTrackingState(self):
+        # nothing is stored until there's something to track
+        self.assertNotIn('_dirty_fields', vars(self.message))
+        buf = bytearray(self.data)
+        s, end = Message.unpack(buf, 2)
+        self.assertNotIn('_dirty_fields', vars(s))
+        self.assertNotIn('_dirty_fields', vars(Message.unpack_lazy(buf, 2)))
+        for record in Message.unpack_many(buf, offset=2):
+            self.assertNotIn('_dirty_fields', vars(record))
+
+        # packed whole, the first time
+        s.checksum = 1
+        self.assertEqual(s.patch_into(buf, 2), end)
+        self.assertEqual(bytes(buf[2:]), s.pack())
+        s, end = Message.unpack(buf, 2, track_changes=True)
+        self.assertEqual(s._dirty_fields, frozenset())
+        Message.unpack_into(s, buf, 2)
+        self.assertIsNone(s._dirty_fields)
+        Message.unpack_into(s, buf, 2, track_changes=True)
+        self.assertEqual(s._dirty_fields, frozenset())
+
+        headers = bytearray(Header.pack_many([Header(kind=1), Header(kind=2)]))
+        self.assertNotIn('_dirty_fields', vars(Header.unpack_many(headers)[0]))
+        for header in Header.unpack_many(headers, track_changes=True):
+            self.assertEqual(header._dirty_fields, frozenset())
+
+    def testNewInstance(self):
+        buf = bytearray(self.data)
+        self.message.checksum = 1
+        self.message.patch_into(buf, 2)
+        self.assertEqual(bytes(buf[2:]), self.message.pack())
+
+
+class IterUnpackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = [
+            Message(header=Header(kind=i), name=b'n' * i + b'\0',
+                    values=list(range(i)),
+                    comment=CStructVarString(text=b'c' * (3 * i)))
+            for i in range(20)]
+        self.data = b''.join(m.pack() for m in self.messages)
+
+    def testChunkBoundaries(self):
+        for buffer_size in (1, 5, 64, 2 ** 16):
+            stream = io.BytesIO(self.data)
+            result = list(Message.iter_unpack(stream, buffer_size=buffer_size))
+            self.assertEqual([m.pack() for m in result],
+                             [m.pack() for m in self.messages])
+
+    def testEmptyStream(self):
+        self.assertEqual(list(Message.iter_unpack(io.BytesIO(b''))), [])
+
+    def testTruncatedStream(self):
+        stream = io.BytesIO(self.data[:-3])
+        records = Message.iter_unpack(stream, buffer_size=7)
+        for _ in range(19):
+            next(records)
+        with self.assertRaises(IncompleteDataException):
+            next(records)
+
+    def testSocket(self):
+        for stream_of in (lambda sock: sock.makefile('rb'), lambda sock: sock):
+            writer, reader = socket.socketpair()
+            try:
+                # fail instead of blocking forever
+                reader.settimeout(2)
+                records = Message.iter_unpack(stream_of(reader))
+                for message in self.messages[:3]:
+                    # the connection stays open - a reply is due first
+                    writer.sendall(message.pack())
+                    self.assertEqual(next(records).pack(), message.pack())
+                writer.close()
+                self.assertEqual(list(records), [])
+            finally:
+                writer.close()
+                reader.close()
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.headers = [Header(kind=i, flags=i % 3) for i in range(100)]
+        self.messages = [
+            Message(header=Header(kind=i), name=b'n' * i + b'\0',
+                    values=list(range(i)),
+                    comment=CStructVarString(text=b'c' * i))
+            for i in range(20)]
+
+    def testFixedLayout(self):
+        data = Header.pack_many(iter(self.headers))
+        self.assertEqual(data, b''.join(h.pack() for h in self.headers))
+
+        headers = Header.unpack_many(data)
+        self.assertEqual([h.pack() for h in headers],
+                         [h.pack() for h in self.headers])
+
+        headers = Header.unpack_many(b'xx' + data, count=3, offset=2 + 4 * 10)
+        self.assertEqual([h.kind for h in headers], [10, 11, 12])
+
+    def testVariableLayout(self):
+        data = Message.pack_many(self.messages)
+        self.assertEqual(data, b''.join(m.pack() for m in self.messages))
+
+        messages = Message.unpack_many(data)
+        self.assertEqual([m.pack() for m in messages],
+                         [m.pack() for m in self.messages])
+        self.assertEqual(len(Message.unpack_many(data, count=5)), 5)
+
+    def testExplicitOffsets(self):
+        class TestStruct(CStruct):
+            name = NullStringField(0)
+            value = IntField(1, offset=4)
+
+        records = [TestStruct(name=b'abc\0', value=i) for i in range(3)]
+        data = TestStruct.pack_many(records)
+        self.assertEqual(data, b''.join(r.pack() for r in records))
+
+    def testTruncated(self):
+        data = Header.pack_many(self.headers)
+        with self.assertRaises(IncompleteDataException):
+            Header.unpack_many(data[:-1])
+        with self.assertRaises(IncompleteDataException):
+            Header.unpack_many(data, count=101)
+        with self.assertRaises(IncompleteDataException):
+            Message.unpack_many(Message.pack_many(self.messages)[:-1])
+
+    def testEmpty(self):
+        self.assertEqual(Header.pack_many([]), b'')
+        self.assertEqual(Message.pack_many([]), b'')
+        self.assertEqual(Header.unpack_many(b''), [])
+        self.assertEqual(Message.unpack_many(b''), [])
+
+
+class DispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        class Ping(CStruct):
+            kind = UShortField(0, prefix=b'\x01\x00', default=1)
+            seq = UIntField(1)
+
+        class Pong(CStruct):
+            kind = UShortField(0, prefix=b'\x02\x00', default=2)
+            seq = UIntField(1)
+
+        class Text(CStruct):
+            kind = UIntField(0, prefix=b'\x03\x00\x00\x00', default=3)
+            text = NullStringField(1)
+
+        class Unknown(CStruct):
+            kind = UShortField(0, prefix=b'')
+
+        self.types = [Ping, Pong, Text]
+        self.Unknown = Unknown
+        self.messages = [Ping(seq=1), Text(text=b'hi\0'), Pong(seq=1)]
+        self.data = b''.join(m.pack() for m in self.messages)
+
+    def testDispatch(self):
+        messages = CStruct.dispatch(self.types)
+        offset = 0
+        for expected in self.messages:
+            message, offset = messages.unpack(bytearray(self.data), offset)
+            self.assertIs(type(message), type(expected))
+            self.assertEqual(message.pack(), expected.pack())
+        self.assertEqual(offset, len(self.data))
+
+    def testNoMatch(self):
+        messages = CStruct.dispatch(self.types)
+        with self.assertRaises(UnpackException):
+            messages.unpack(b'\x04\x00\x00\x00')
+        # data ending within a prefix
+        with self.assertRaises(IncompleteDataException) as cm:
+            messages.unpack(b'\x03\x00')
+        self.assertEqual(cm.exception.needed, 2)
+
+        # empty prefix as the fallback
+        messages = CStruct.dispatch(self.types + [self.Unknown])
+        message, offset = messages.unpack(b'\x04\x00')
+        self.assertIs(type(message), self.Unknown)
+
+    def testAmbiguous(self):
+        with self.assertRaisesRegexp(ValueError, "same prefix"):
+            CStruct.dispatch(self.types + self.types[:1])
+        with self.assertRaisesRegexp(ValueError, "Header has no prefix"):
+            CStruct.dispatch([Header])
+
+
+class StreamReadTest(unittest.TestCase):
+
+    def setUp(self):
+        class TestStruct(CStruct):
+            length = UIntField(0)
+            text = StringField(1, length='length')
+            checksum = UIntField(2, default=0xcafebabe)
+
+        self.TestStruct = TestStruct
+        self.value = TestStruct(text=b'Hello World!')
+        self.data = self.value.pack()
+
+    def testNeededBytes(self):
+        reader = self.TestStruct.reader()
+        needed = []
+        data = self.data
+        while reader.needed:
+            needed.append(reader.needed)
+            reader.feed(data[:reader.needed])
+            data = data[needed[-1]:]
+        self.assertEqual(needed, [4, 12, 4])
+        self.assertEqual(reader.result.text, b'Hello World!')
+        self.assertEqual(reader.result.checksum, 0xcafebabe)
+
+    def testSmallChunks(self):
+        unpacked = []
+
+        class CountingStruct(self.TestStruct):
+            @classmethod
+            def unpack(cls, data, offset=0, validate=False, fields=None):
+                unpacked.append(len(data))
+                return self.TestStruct.unpack.__func__(cls, data, offset,
+                                                       validate, fields)
+
+        reader = CountingStruct.reader()
+        for i in range(len(self.data)):
+            reader.feed(self.data[i:i + 1])
+        self.assertEqual(reader.needed, 0)
+        self.assertEqual(reader.result.text, b'Hello World!')
+        # only once the reported number of bytes is there
+        self.assertEqual(unpacked, [0, 4, 16, 20])
+
+    def testFeedTooMuch(self):
+        reader = self.TestStruct.reader()
+        with self.assertRaisesRegexp(ValueError, "only 4 needed"):
+            reader.feed(self.data + self.data)
+        # the data wasn't taken
+        self.assertEqual(reader.needed, 4)
+        reader.feed(self.data[:4])
+        with self.assertRaises(ValueError):
+            reader.feed(self.data[4:])
+        self.assertEqual(reader.needed, 12)
+
+    def testReadFrom(self):
+        stream = io.BytesIO(self.data + b'trailing data')
+        s = self.TestStruct.read_from(stream)
+        self.assertEqual(s.text, b'Hello World!')
+        # nothing was over-read
+        self.assertEqual(stream.read(), b'trailing data')
+
+    def testReadFromTruncated(self):
+        stream = io.BytesIO(self.data[:-1])
+        with self.assertRaises(IncompleteDataException):
+            self.TestStruct.read_from(stream)
+
+    def testWriteTo(self):
+        stream = io.BytesIO()
+        self.value.write_to(stream)
+        self.value.write_to(stream)
+        self.assertEqual(stream.getvalue(), self.data * 2)
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class NumpyTest(unittest.TestCase):
+
+    def setUp(self):
+        class Record(CStruct):
+            header = StructField(0, struct=Header)
+            name = StringField(1, length=4)
+            samples = ArrayField(2, length=3, subfield=IntField(0))
+            value = UIntField(3)
+
+        self.Record = Record
+        self.records = [Record(header=Header(kind=i, flags=1), name=b'r%d' % i,
+                               samples=[i, -i, 2 * i], value=i * 1000)
+                        for i in range(10)]
+        self.data = b''.join(r.pack() for r in self.records)
+
+    def testDtype(self):
+        dtype = self.Record.numpy_dtype()
+        self.assertEqual(dtype.names, ('header', 'name', 'samples', 'value'))
+        self.assertEqual(dtype.itemsize, len(self.data) // 10)
+        self.assertEqual(dtype['value'], numpy.dtype('<u4'))
+
+    def testUnpackArray(self):
+        array = self.Record.unpack_array(self.data)
+        self.assertEqual(len(array), 10)
+        self.assertEqual(list(array['value']), [i * 1000 for i in range(10)])
+        self.assertEqual(list(array['header']['kind']), list(range(10)))
+        self.assertEqual(list(array['samples'][3]), [3, -3, 6])
+        self.assertEqual(array['name'][2], b'r2')
+
+        array = self.Record.unpack_array(b'xx' + self.data, count=2, offset=2)
+        self.assertEqual(list(array['value']), [0, 1000])
+
+    def testArrayBuffer(self):
+        samples = self.records[3].samples
+        view = numpy.frombuffer(samples, dtype=samples.typecode)
+        self.assertEqual(list(view), [3, -3, 6])
+
+    def testVariableSize(self):
+        with self.assertRaisesRegexp(ValueError, "name has no fixed size"):
+            Message.numpy_dtype()
+
+
+class ThreadSafetyTest(unittest.TestCase):
+    THREADS = 8
+    ROUNDS = 100
+
+    def setUp(self):
+        # switch threads as often as possible
+        if hasattr(sys, 'setswitchinterval'):
+            self._interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+        else:
+            self._interval = sys.getcheckinterval()
+            sys.setcheckinterval(1)
+
+    def tearDown(self):
+        if hasattr(sys, 'setswitchinterval'):
+            sys.setswitchinterval(self._interval)
+        else:
+            sys.setcheckinterval(self._interval)
+
+    def testConcurrentPackUnpack(self):
+        class TestStruct(CStruct):
+            count = UIntField(0)
+            names = ArrayField(1, length='count', subfield=NullStringField(0))
+            headers = ArrayField(2, length=2, subfield=StructField(0, struct=Header))
+            values = ArrayField(3, length='count', subfield=IntField(0))
+
+        errors = []
+
+        def work(n):
+            try:
+                s = TestStruct(names=[b'%d-%d\0' % (n, i) for i in range(5)],
+                               headers=[Header(kind=n), Header(flags=n)],
+                               values=[n * i for i in range(5)])
+                expected = s.pack()
+                for _ in range(self.ROUNDS):
+                    data = s.pack()
+                    u, offset = TestStruct.unpack(data)
+                    if data != expected or u.pack() != expected:
+                        errors.append(n)
+                        return
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class SlotsTest(unittest.TestCase):
+
+    def setUp(self):
+        class Compact(CStruct):
+            class Meta:
+                slots = True
+
+            id = UIntField(0)
+            name = NullStringField(1, default=b'\0')
+            values = ArrayField(2, length=2, subfield=IntField(0))
+
+        class Derived(Compact):
+            extra = IntField(3)
+
+        self.Compact = Compact
+        self.Derived = Derived
+
+    def testNoDict(self):
+        for klass in (self.Compact, self.Derived):
+            s = klass(id=5, values=[1, 2])
+            self.assertFalse(hasattr(s, '__dict__'))
+            with self.assertRaises(AttributeError):
+                s.not_a_field = 1
+        self.assertEqual(self.Derived.__slots__, ('_extra',))
+        self.assertNotIn('_packed', self.Compact.__slots__)
+
+    def testUnpack(self):
+        data = self.Derived(id=5, name=b'x\0', values=[1, 2], extra=-1).pack()
+        s, offset = self.Derived.unpack(data)
+        self.assertEqual((s.id, s.name, s.values, s.extra), (5, b'x\0', [1, 2], -1))
+
+        s = self.Derived.unpack_lazy(data)
+        self.assertEqual(s.extra, -1)
+        self.assertEqual(s.pack(), data)
+
+
+class FrozenTest(unittest.TestCase):
+
+    def setUp(self):
+        class Point(FrozenCStruct):
+            x = IntField(0)
+            y = IntField(1)
+
+        class Path(FrozenCStruct):
+            class Meta:
+                slots = True
+
+            start = StructField(0, struct=Point)
+            name = NullStringField(1, default=b'\0')
+            count = UIntField(2)
+            steps = ArrayField(3, length='count', subfield=IntField(0))
+
+        self.Point, self.Path = Point, Path
+        self.path = Path(start=Point(x=1, y=2), name=b'up\0', steps=[1, -1])
+
+    def testImmutable(self):
+        with self.assertRaisesRegexp(AttributeError, "Path is frozen"):
+            self.path.name = b'down\0'
+        with self.assertRaisesRegexp(AttributeError, "Point is frozen"):
+            self.path.start.x = 5
+        self.assertEqual(self.path.steps, (1, -1))
+        with self.assertRaises(TypeError):
+            self.path.steps[0] = 5
+
+        s, offset = self.Path.unpack(self.path.pack())
+        self.assertEqual(s.steps, (1, -1))
+        with self.assertRaises(AttributeError):
+            s.count = 1
+        with self.assertRaises(AttributeError):
+            self.Path.unpack_lazy(self.path.pack()).count = 1
+
+    def testPack(self):
+        data = self.path.pack()
+        self.assertIs(self.path.pack(), data)
+        self.assertEqual(self.path.packed_size(), len(data))
+        self.assertEqual(data, struct.pack('<ii3sIii', 1, 2, b'up\0', 2, 1, -1))
+
+        buf = bytearray(len(data) + 1)
+        self.assertEqual(self.path.pack_into(buf, 1), len(buf))
+        self.assertEqual(bytes(buf[1:]), data)
+        self.assertEqual(self.Path.pack_many([self.path] * 2), data * 2)
+        with self.assertRaises(PackException):
+            self.path.pack_into(bytearray(len(data) - 1))
+        self.assertIn('_packed', self.Path.__slots__)
+
+        s, offset = self.Path.unpack(data, validate=True)
+        self.assertEqual(s.pack(), data)
+
+    def testHash(self):
+        same = self.Path.unpack(self.path.pack())[0]
+        self.assertEqual(same, self.path)
+        self.assertEqual(hash(same), hash(self.path))
+        self.assertNotEqual(self.path, self.Path(start=self.Point()))
+        self.assertEqual(len(set([same, self.path, self.Point()])), 2)
+
+    def testNoReuse(self):
+        with self.assertRaises(TypeError):
+            self.Path.pool()
+        with self.assertRaises(ValueError):
+            self.Path.unpack_into(self.path, self.path.pack())
+
+    def testMutableNested(self):
+        with self.assertRaisesRegexp(ValueError, "Header, which isn't frozen"):
+            class Frozen(FrozenCStruct):
+                header = StructField(0, struct=Header)
+
+    def testExplicitOffset(self):
+        with self.assertRaisesRegexp(ValueError, "y of frozen structure P "
+                                                 "has an explicit offset"):
+            class P(FrozenCStruct):
+                x = IntField(0)
+                y = IntField(1, offset=4)
+
+        class P(CStruct):
+            x = IntField(0)
+            y = IntField(1, offset=4)
+
+        class Q(CStruct):
+            head = IntField(0)
+            p = StructField(1, struct=P)
+
+        # offsets are relative to the outermost structure - the packed
+        # form of P depends on where it's nested
+        with self.assertRaises(PackException):
+            Q(p=P()).pack()
+
+
+class UnpackIntoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = [Message(header=Header(kind=i), name=b'm\0',
+                                 values=[i, -i], checksum=i,
+                                 comment=CStructVarString(text=b'c'))
+                         for i in range(3)]
+        self.data = Message.pack_many(self.messages)
+
+    def testReuse(self):
+        s, offset = Message.unpack(self.data)
+        offset = Message.unpack_into(s, self.data, offset)
+        self.assertEqual(offset, len(self.messages[0].pack()) * 2)
+        self.assertEqual((s.header.kind, s.checksum), (1, 1))
+        self.assertEqual(s.values, [1, -1])
+        self.assertEqual(s.pack(), self.messages[1].pack())
+
+    def testReuseArray(self):
+        class Names(CStruct):
+            count = UIntField(0)
+            names = ArrayField(1, length='count', subfield=NullStringField(0))
+
+        data = Names(names=[b'a\0', b'b\0']).pack()
+        s, offset = Names.unpack(data)
+        names = s.names
+        Names.unpack_into(s, Names(names=[b'c\0']).pack())
+        self.assertIs(s.names, names)
+        self.assertEqual(s.names, [b'c\0'])
+        with self.assertRaisesRegexp(ValueError, "must a string"):
+            s.names[0] = b'x'
+
+    def testIncomplete(self):
+        s = Message.unpack_lazy(self.data)
+        with self.assertRaises(IncompleteDataException):
+            Message.unpack_into(s, self.data[:-1], len(self.messages[0].pack()) * 2)
+        self.assertEqual(s.checksum, 0)
+        with self.assertRaises(ValueError):
+            Message.unpack_into(Header(), self.data)
+
+    def testValidate(self):
+        s = Message.pool().acquire()
+        Message.unpack_into(s, self.data, validate=True)
+        self.assertEqual(s.pack(), self.messages[0].pack())
+
+    def testPool(self):
+        pool = Message.pool(size=1)
+        offset, seen = 0, []
+        while offset < len(self.data):
+            message, offset = pool.unpack(self.data, offset)
+            seen.append((message.checksum, id(message)))
+            pool.release(message)
+        self.assertEqual([checksum for (checksum, _) in seen], [0, 1, 2])
+        self.assertEqual(len(set(ident for (_, ident) in seen)), 1)
+
+    def testPoolNested(self):
+        class Envelope(CStruct):
+            tag = NullStringField(0)
+            message = StructField(1, struct=Message)
+
+        # a fixed structure (in a run of fixed fields) and a variable one
+        data = Envelope.pack_many(Envelope(tag=b't\0', message=m)
+                                  for m in self.messages * 3)
+        pool = Envelope.pool(size=1)
+        offset, seen = 0, []
+        while offset < len(data):
+            envelope, offset = pool.unpack(data, offset)
+            message = envelope.message
+            seen.append((id(message), id(message.header)))
+            self.assertEqual(message.pack(),
+                             self.messages[len(seen) % 3 - 1].pack())
+            pool.release(envelope)
+        # the nested instances trade places with the spares - there's
+        # a fixed number of them, whatever the number of records
+        self.assertEqual(len(set(message for (message, _) in seen)), 2)
+        self.assertTrue(len(set(header for (_, header) in seen)) <= 3)
+        self.assertEqual(pool._scratch.values, {})
+
+    def testNestedIncomplete(self):
+        class Envelope(CStruct):
+            message = StructField(0, struct=Message)
+            tail = UIntField(1)
+
+        data = Envelope(message=self.messages[1], tail=7).pack()
+        s = Envelope(message=self.messages[0])
+        message, header = s.message, s.message.header
+        pool = Envelope.pool()
+        with self.assertRaises(IncompleteDataException):
+            Envelope._unpack_into(s, data[:-1], scratch=pool._scratch)
+        # nothing changed
+        self.assertIs(s.message, message)
+        self.assertIs(s.message.header, header)
+        self.assertEqual(s.message.pack(), self.messages[0].pack())
+
+        Envelope._unpack_into(s, data, scratch=pool._scratch)
+        self.assertEqual((s.message.pack(), s.tail),
+                         (self.messages[1].pack(), 7))
+        self.assertIsNot(s.message, message)
+
+    def testSlots(self):
+        class Compact(CStruct):
+            class Meta:
+                slots = True
+
+            id = UIntField(0)
+            names = ArrayField(1, length=-1, subfield=NullStringField(0))
+
+        data = Compact(id=1, names=[b'a\0']).pack()
+        s, offset = Compact.pool().unpack(data)
+        self.assertEqual((s.id, s.names), (1, [b'a\0']))
+
+        s = Compact(id=2)
+        self.assertEqual(Compact.unpack_into(s, data), len(data))
+        self.assertEqual((s.id, s.names), (1, [b'a\0']))
@@ -1,11 +1,108 @@
 # -*- coding: utf-8
+import array
 import sys
 
+from pystruct.common import PackException
+
 if sys.version_info < (2, 7):
     import unittest2 as unittest
 else:
     import unittest
 
+try:
+    # objects exposing only the old buffer interface (mmap on Python 2)
+    # can't be wrapped in a memoryview
+    VIEW_TYPES = (memoryview, buffer)
+except NameError:
+    VIEW_TYPES = (memoryview,)
+
+# how many bytes are copied at once when scanning a memoryview
+SCAN_CHUNK = 4096
+
+# structures are always packed little-endian
+LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def buffer_slice(data, start, stop):
+    """
+    Zero-copy slice of any object supporting the buffer interface
+    (`bytes`, `bytearray`, `mmap`, `memoryview`).
+    """
+    try:
+        return memoryview(data)[start:stop]
+    except TypeError:
+        return buffer(data, start, stop - start)
+
+
+def to_bytes(value):
+    """Copy a buffer slice (see `buffer_slice`) to a byte string."""
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    if isinstance(value, VIEW_TYPES + (bytearray,)):
+        return bytes(value)
+    return value
+
+
+def find_byte(data, byte, start, end=None):
+    """
+    Index of the first `byte` in `data[start:end]`, or -1 if there
+    is none. Works on any buffer, without copying it as a whole.
+    """
+    found = find_bytes(data, byte, start, 1, end)
+    return found[0] if found else -1
+
+
+def find_bytes(data, byte, start, count=None, end=None):
+    """
+    Indexes of the first `count` occurences of `byte` in
+    `data[start:end]` (all of them by default), found in a single pass.
+    Fewer are returned if the data ends first.
+    """
+    if end is None:
+        end = len(data)
+    found = []
+    find = getattr(data, 'find', None)
+    if find is not None:
+        while start < end and (count is None or len(found) < count):
+            index = find(byte, start, end)
+            if index < 0:
+                break
+            found.append(index)
+            start = index + 1
+        return found
+
+    # memoryview has no find() - scan it piece by piece,
+    # copying each piece only once
+    while start < end and (count is None or len(found) < count):
+        stop = min(start + SCAN_CHUNK, end)
+        chunk = to_bytes(data[start:stop])
+        index = chunk.find(byte)
+        while index >= 0 and (count is None or len(found) < count):
+            found.append(start + index)
+            index = chunk.find(byte, index + 1)
+        start = stop
+    return found
+
+
+class PackBuffer(bytearray):
+    """
+    A buffer, which grows as structures are packed into it (see
+    `reserve`), so their size doesn't have to be computed up front.
+    """
+
+
+def reserve(buf, end):
+    """
+    Make sure a `PackBuffer` is at least `end` bytes long. Other buffers
+    don't grow - `PackException` is raised if they're shorter.
+    """
+    missing = end - len(buf)
+    if missing > 0:
+        if not isinstance(buf, PackBuffer):
+            raise PackException("Not enough space in the buffer, {0} more "
+                                "bytes needed.".format(missing))
+        buf.extend(b'\0' * missing)
+
 
 class ItemWrapper(object):
     """
@@ -70,3 +167,170 @@ class ListItemWrapper(ItemWrapper):
             self._object[key] = self._set_action(self, name, value)
         except ValueError:
             return ItemWrapper.__setattr__(self, name, value)
+
+
+class TypedArray(array.array):
+    """
+    A compact array of numbers, stored as C values (see `array.array`)
+    instead of a list of Python objects. New items are validated in bulk
+    by `check` (a callable taking a sequence of items) before they are
+    written. The array exposes the buffer interface, so it can be handed
+    to file writes or NumPy without copying.
+
+    The initial `items` are not checked - validate them beforehand.
+    Unless `resizable` is set, the length of the array can't be changed
+    (e.g. when it's stored in another field) - `append`, `extend`, etc.
+    raise `TypeError`.
+    """
+    __slots__ = ('_check', '_resizable')
+
+    def __new__(cls, typecode, items=(), check=None, resizable=True):
+        return array.array.__new__(cls, str(typecode), items)
+
+    def __init__(self, typecode, items=(), check=None, resizable=True):
+        self._check = check
+        self._resizable = resizable
+
+    if not hasattr(array.array, 'tobytes'):  # Python 2
+        tobytes = array.array.tostring
+        _frombytes = array.array.fromstring
+    else:
+        _frombytes = array.array.frombytes
+
+    def _validate(self, items):
+        if self._check is not None:
+            self._check(items)
+        return items
+
+    def _resize(self):
+        if not self._resizable:
+            raise TypeError("The length of the array is fixed - assign "
+                            "a new array to the field instead.")
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = array.array(self.typecode, self._validate(list(value)))
+            if len(value) != len(range(*index.indices(len(self)))):
+                self._resize()
+        else:
+            self._validate((value,))
+        array.array.__setitem__(self, index, value)
+
+    def __setslice__(self, start, stop, value):
+        # Python 2 doesn't go through __setitem__ for simple slices
+        self.__setitem__(slice(start, stop), value)
+
+    def __delitem__(self, index):
+        self._resize()
+        array.array.__delitem__(self, index)
+
+    def __delslice__(self, start, stop):
+        self.__delitem__(slice(start, stop))
+
+    def append(self, value):
+        self._resize()
+        array.array.append(self, self._validate((value,))[0])
+
+    def insert(self, index, value):
+        self._resize()
+        array.array.insert(self, index, self._validate((value,))[0])
+
+    def extend(self, items):
+        self._resize()
+        array.array.extend(self, array.array(self.typecode,
+                                             self._validate(list(items))))
+
+    def pop(self, *index):
+        self._resize()
+        return array.array.pop(self, *index)
+
+    def remove(self, value):
+        self._resize()
+        array.array.remove(self, value)
+
+    def __iadd__(self, other):
+        self._resize()
+        if isinstance(other, array.array):
+            self._validate(other.tolist())
+        return array.array.__iadd__(self, other)
+
+    def __imul__(self, count):
+        self._resize()
+        return array.array.__imul__(self, count)
+
+    def fromlist(self, items):
+        self._resize()
+        array.array.fromlist(self, self._validate(list(items)))
+
+    def frombytes(self, data):
+        self._resize()
+        items = array.array(self.typecode)
+        TypedArray._frombytes(items, data)
+        self._validate(items.tolist())
+        array.array.extend(self, items)
+
+    if not hasattr(array.array, 'tobytes'):  # Python 2
+        fromstring = frombytes
+
+    def fromfile(self, f, n):
+        self._resize()
+        items = array.array(self.typecode)
+        try:
+            items.fromfile(f, n)
+        finally:
+            # the items read before the end of the file are kept
+            self._validate(items.tolist())
+            array.array.extend(self, items)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple)):
+            return self.tolist() == list(other)
+        return array.array.__eq__(self, other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def packed(self):
+        """The items as little-endian bytes."""
+        if LITTLE_ENDIAN:
+            return self.tobytes()
+        swapped = array.array(self.typecode, self)
+        swapped.byteswap()
+        return swapped.tobytes()
+
+    def pack_into(self, buf, offset):
+        """
+        Write the items as little-endian bytes to `buf` at `offset`,
+        without copying them to a byte string first. Returns the end offset.
+        """
+        items = self
+        if not LITTLE_ENDIAN:
+            items = array.array(self.typecode, self)
+            items.byteswap()
+        end = offset + len(items) * items.itemsize
+        if end > len(buf):
+            raise ValueError("Buffer too small for {0} items at offset {1}."
+                             .format(len(items), offset))
+        try:
+            buf[offset:end] = memoryview(items).cast('B')
+        except (TypeError, AttributeError):  # Python 2
+            try:
+                buf[offset:end] = buffer(items)
+            except (TypeError, IndexError):
+                buf[offset:end] = items.tobytes()  # e.g. a mmap
+        return end
+
+    def load(self, data):
+        """Append items from little-endian `data` (any buffer)."""
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        elif isinstance(data, bytearray):
+            data = bytes(data)
+        if LITTLE_ENDIAN:
+            self._frombytes(data)
+        else:
+            items = array.array(self.typecode)
+            TypedArray._frombytes(items, data)
+            items.byteswap()
+            array.array.extend(self, items)